@@ -1,10 +1,267 @@
+import time
+
 from ckan.logic import side_effect_free, get_or_bust
-import ckanext.datastore.backend as datastore_backend
+import ckan.authz as authz
+from ckan.lib.redis import connect_to_redis
 import ckan.plugins.toolkit as toolkit
 from ckanext.wakeua import logic as logic
+from ckanext.wakeua import artifacts
+from ckanext.wakeua import jobs
+from ckanext.wakeua import helpers
+from ckanext.wakeua import ontology
+from ckanext.datastore import helpers as datastore_helpers
+
+
+# seconds the list of datastore resources is cached for
+DATASTORE_RESOURCES_TTL = 'ckanext.wakeua.datastore_resources.cache_ttl'
+
+# {'resources': [...], 'expires': timestamp, 'version': ...}
+_datastore_resources_cache = {}
+
+# Redis key incremented by datastore_create/delete in any process (usually
+# the xloader worker), the cache of the web processes is refreshed when it
+# changes
+DATASTORE_RESOURCES_VERSION = 'ckanext.wakeua.datastore_resources.version'
 
 
 @side_effect_free
 def list_datastore_resources(context, data_dict):
-    resource_ids = datastore_backend.get_all_resources_ids_in_datastore()
-    return resource_ids
+    """
+    Return the ids of the resources in the datastore, sorted. Resources of
+    private datasets are only listed for sysadmins.
+
+    :param organization: only resources of this organization (name or id)
+        (optional)
+    :type organization: string
+    :param format: only resources with this format, e.g. CSV (optional)
+    :type format: string
+    :param has_ontology: only resources whose data dictionary has (true) or
+        hasn't (false) an ontology mapping (optional)
+    :type has_ontology: bool
+    :param limit: maximum number of resources returned (optional)
+    :type limit: int
+    :param offset: resources skipped (optional, default 0)
+    :type offset: int
+    :param all_fields: return dicts with the id, package_id, organization,
+        format and has_ontology of each resource (optional, default false)
+    :type all_fields: bool
+    :param include_stats: add the estimated rows and the table size in
+        bytes to the dicts, implies all_fields (optional, default false)
+    :type include_stats: bool
+
+    :rtype: list of strings or dictionaries
+    """
+    limit = data_dict.get('limit')
+    limit = None if limit in (None, '') else _positive_int(limit, 'limit')
+    offset = _positive_int(data_dict.get('offset') or 0, 'offset')
+
+    resources = _datastore_resources()
+    if not authz.is_sysadmin(context.get('user')):
+        resources = [r for r in resources if not r['private']]
+    organization = data_dict.get('organization')
+    if organization:
+        resources = [r for r in resources if organization in (r['organization'], r['owner_org'])]
+    resource_format = data_dict.get('format')
+    if resource_format:
+        resources = [r for r in resources if r['format'].lower() == resource_format.lower()]
+    if data_dict.get('has_ontology') not in (None, ''):
+        has_ontology = toolkit.asbool(data_dict['has_ontology'])
+        resources = [r for r in resources if r['has_ontology'] == has_ontology]
+
+    resources = resources[offset:None if limit is None else offset + limit]
+    include_stats = toolkit.asbool(data_dict.get('include_stats', False))
+    if include_stats:
+        fields = ['id', 'package_id', 'organization', 'format', 'has_ontology', 'rows', 'size']
+    elif toolkit.asbool(data_dict.get('all_fields', False)):
+        fields = ['id', 'package_id', 'organization', 'format', 'has_ontology']
+    else:
+        return [r['id'] for r in resources]
+    return [{k: r[k] for k in fields} for r in resources]
+
+
+def _positive_int(value, name):
+    try:
+        value = toolkit.asint(value)
+    except ValueError:
+        raise toolkit.ValidationError({name: [toolkit._(u'Invalid integer')]})
+    if value < 0:
+        raise toolkit.ValidationError({name: [toolkit._(u'Must be a positive integer')]})
+    return value
+
+
+def _datastore_resources():
+    cache = _datastore_resources_cache
+    version = connect_to_redis().get(DATASTORE_RESOURCES_VERSION)
+    if cache.get('expires', 0) < time.time() or cache.get('version') != version:
+        cache['resources'] = logic.datastore_resources()
+        cache['expires'] = time.time() + toolkit.asint(toolkit.config.get(DATASTORE_RESOURCES_TTL, 60))
+        cache['version'] = version
+    return cache['resources']
+
+
+def _clear_datastore_resources_cache():
+    _datastore_resources_cache.clear()
+    connect_to_redis().incr(DATASTORE_RESOURCES_VERSION)
+
+
+@toolkit.chained_action
+def datastore_create(original_action, context, data_dict):
+    fields = data_dict.get('fields') or []
+    if _ontology_changed(data_dict.get('resource_id'), fields):
+        # reject bad ontology mappings when the data dictionary is saved
+        errors = ontology.validate_ontology_dictionary(fields)
+        if errors:
+            raise toolkit.ValidationError(errors)
+    result = original_action(context, data_dict)
+    # new tables and data dictionary changes (has_ontology)
+    _clear_datastore_resources_cache()
+    if data_dict.get('records') and result.get('resource_id'):
+        artifacts.bump_datastore_version(result['resource_id'])
+    if fields and result.get('resource_id'):
+        # compile the plan of whole-resource exports right away
+        ontology.get_ontology_plan(result['resource_id'], fields, ontology.export_columns(fields))
+    return result
+
+
+def _ontology_changed(resource_id, fields):
+    # loads (e.g. by xloader) carry the existing data dictionary over, only
+    # validate the mapping when it is edited
+    new = {f['id']: (f.get('info') or {}).get('ontology') or '' for f in fields}
+    if not any(new.values()):
+        return False
+    try:
+        current = datastore_helpers.datastore_dictionary(resource_id) if resource_id else []
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized, toolkit.ValidationError):
+        current = []
+    current = {f['id']: (f.get('info') or {}).get('ontology') or '' for f in current}
+    return any(current.get(field_id, '') != value for field_id, value in new.items())
+
+
+@toolkit.chained_action
+def datastore_delete(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    _clear_datastore_resources_cache()
+    artifacts.bump_datastore_version(data_dict['resource_id'])
+    return result
+
+
+@toolkit.chained_action
+def datastore_upsert(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    # rows written without changing the resource metadata
+    artifacts.bump_datastore_version(data_dict['resource_id'])
+    return result
+
+
+def _clearing_vocabulary_tags_cache(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    helpers.clear_vocabulary_tags_cache()
+    return result
+
+
+tag_create = toolkit.chained_action(_clearing_vocabulary_tags_cache)
+tag_delete = toolkit.chained_action(_clearing_vocabulary_tags_cache)
+vocabulary_create = toolkit.chained_action(_clearing_vocabulary_tags_cache)
+vocabulary_update = toolkit.chained_action(_clearing_vocabulary_tags_cache)
+vocabulary_delete = toolkit.chained_action(_clearing_vocabulary_tags_cache)
+
+
+# seconds without progress after which a pending or running export is
+# considered lost (e.g. the worker died) and can be submitted again
+EXPORT_STALE_AFTER = 600
+
+
+def export_rdf(context, data_dict):
+    """
+    Convert the whole datastore data of a resource to RDF in a background
+    job, storing the result so it can be downloaded (and resumed with HTTP
+    Range requests) from the export endpoint. Nothing is enqueued if the
+    export is already stored or in progress. Only for users who can update
+    the resource.
+
+    :param resource_id: id of the datastore resource
+    :type resource_id: string
+    :param file_format: RDF format of the export (optional, default
+        rdf_segittur), see logic.RDF_FORMATS
+    :type file_format: string
+
+    :returns: the status of the export, see wakeua_export_rdf_status
+    :rtype: dictionary
+    """
+    resource_id = get_or_bust(data_dict, 'resource_id')
+    toolkit.check_access('wakeua_export_rdf', context, data_dict)
+    file_format = data_dict.get('file_format', 'rdf_segittur')
+    status = export_rdf_status(context, {'resource_id': resource_id, 'file_format': file_format})
+    if status['state'] == 'complete':
+        return status
+    if status['state'] in ('pending', 'running') and time.time() - status['updated'] < EXPORT_STALE_AFTER:
+        return status
+
+    # before enqueueing, so it doesn't overwrite the status of a fast worker
+    artifacts.write_status(resource_id, file_format, state='pending', key=status['key'])
+    try:
+        toolkit.enqueue_job(jobs.build_rdf_artifact, [resource_id, file_format],
+                            title='wakeua RDF export ' + resource_id)
+    except Exception as e:
+        artifacts.write_status(resource_id, file_format, state='error', key=status['key'], error=str(e))
+        raise
+    return export_rdf_status(context, {'resource_id': resource_id, 'file_format': file_format})
+
+
+@side_effect_free
+def export_rdf_status(context, data_dict):
+    """
+    Return the status of the background RDF export of a resource.
+
+    :param resource_id: id of the datastore resource
+    :type resource_id: string
+    :param file_format: RDF format of the export (optional, default
+        rdf_segittur)
+    :type file_format: string
+
+    :returns: `state` (not_started, pending, running, complete or error),
+        `rows` converted out of `total_rows`, `progress` (0 to 1), `bytes`
+        written, `error`, `download_url` once complete and the
+        `data_version` to pass as `since` to the export endpoint
+    :rtype: dictionary
+    """
+    resource_id = get_or_bust(data_dict, 'resource_id')
+    file_format = data_dict.get('file_format', 'rdf_segittur')
+    rdf_format = logic.RDF_FORMATS.get(file_format)
+    if rdf_format is None or rdf_format['internal']:
+        raise toolkit.ValidationError({'file_format': [toolkit._(u'RDF format unknown')]})
+    if artifacts.artifacts_path() is None:
+        raise toolkit.ValidationError({'file_format': [toolkit._(u'RDF exports storage is not configured')]})
+
+    # checks the user can read the resource
+    metadata = logic.export_metadata(context, resource_id)
+    key = artifacts.artifact_key(file_format, *metadata)
+
+    status = artifacts.read_status(resource_id, file_format) or {}
+    if status.get('key') != key:
+        # status of an older version of the resource
+        status = {}
+    if artifacts.get_artifact(resource_id, file_format, key, rdf_format['extension']):
+        status['state'] = 'complete'
+
+    total_rows = status.get('total_rows')
+    result = {
+        'resource_id': resource_id,
+        'file_format': file_format,
+        'key': key,
+        'data_version': artifacts.data_version(*metadata),
+        'state': status.get('state', 'not_started'),
+        'updated': status.get('updated'),
+        'rows': status.get('rows', 0),
+        'total_rows': total_rows,
+        'progress': 1.0 if status.get('state') == 'complete' else (
+            float(status.get('rows', 0)) / total_rows if total_rows else None),
+        'bytes': status.get('bytes', 0),
+        'error': status.get('error'),
+        'download_url': None,
+    }
+    if result['state'] == 'complete':
+        result['download_url'] = toolkit.url_for(
+            'wakeua.wakeua_export_resource_data', resource_id=resource_id, file_format=file_format,
+            _external=True)
+    return result
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from ckan.plugins.toolkit import config
+from ckanext.wakeua import locations
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# RDF exports are materialized under <ckan.storage_path>/wakeua/rdf/<resource_id>/
+ARTIFACTS_DIR = os.path.join('wakeua', 'rdf')
+
+# changed whenever the triples generated from the same data change (e.g. the
+# subject URIs), so older artifacts and snapshots are not used
+EXPORT_VERSION = 3
+
+# changed on every write to the datastore table of the resource, which
+# doesn't update the resource metadata
+DATASTORE_VERSION_FILE = 'datastore.version'
+
+
+def artifacts_path():
+    """
+    Return the directory where export artifacts are stored, or None if the
+    site has no local storage configured (caching is disabled then).
+    """
+    storage_path = config.get('ckan.storage_path')
+    if not storage_path:
+        return None
+    return os.path.join(storage_path, ARTIFACTS_DIR)
+
+
+def datastore_version(resource_id):
+    """
+    Return the version of the datastore records of the resource, set by
+    bump_datastore_version (empty if never written since).
+    """
+    path = artifacts_path()
+    if path is None:
+        return ''
+    try:
+        with open(os.path.join(path, resource_id, DATASTORE_VERSION_FILE)) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+
+def bump_datastore_version(resource_id):
+    """
+    Give the datastore records of the resource a new version, after rows
+    were inserted, updated or deleted, so its stored exports are not served
+    and deltas are computed from a new snapshot.
+    """
+    path = artifacts_path()
+    if path is None:
+        return
+    directory = os.path.join(path, resource_id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, os.path.join(directory, DATASTORE_VERSION_FILE))
+
+
+def is_cacheable(data):
+    """
+    Whether the validated export query parameters ask for the whole
+    resource in its default order, the only exports that are cached.
+    """
+    return (
+        not data.get(u'offset')
+        and data.get(u'limit') is None
+        and data.get(u'sort', u'_id') == u'_id'
+        and not any(data.get(k) for k in [
+            u'filters', u'q', u'distinct', u'plain', u'language', u'fields'])
+    )
+
+
+def data_version(resource_metadata, package_metadata, datastore_info):
+    """
+    Identify the version of the RDF of a resource: the resource version
+    (updated by xloader on every load), the datastore version (updated by
+    other writes to the table) and everything else the triples depend on
+    (data dictionary ontology mapping, organization and its
+    location, URI scheme).
+    """
+    version = resource_metadata.get('metadata_modified') or resource_metadata.get('last_modified') or ''
+    organization = (package_metadata.get('organization') or {}).get('name')
+    dependencies = json.dumps({
+        'export': EXPORT_VERSION,
+        'version': version,
+        'datastore': datastore_version(resource_metadata.get('id') or ''),
+        'organization': organization,
+        'location': locations.organization_location(organization),
+        'fields': [[f.get('id'), f.get('type'), (f.get('info') or {}).get('ontology')] for f in datastore_info],
+    }, sort_keys=True)
+    return hashlib.sha1(dependencies.encode('utf-8')).hexdigest()
+
+
+def artifact_key(file_format, resource_metadata, package_metadata, datastore_info):
+    """
+    Key identifying an export of the resource data in `file_format`.
+    """
+    version = data_version(resource_metadata, package_metadata, datastore_info)
+    return hashlib.sha1((file_format + '-' + version).encode('utf-8')).hexdigest()
+
+
+def artifact_path(resource_id, file_format, key, extension):
+    path = artifacts_path()
+    if path is None:
+        return None
+    return os.path.join(path, resource_id, file_format + '-' + key + '.' + extension)
+
+
+def get_artifact(resource_id, file_format, key, extension):
+    """
+    Return the path of the stored artifact, or None if it is not there.
+    """
+    path = artifact_path(resource_id, file_format, key, extension)
+    if path and os.path.isfile(path):
+        return path
+    return None
+
+
+def write_artifact(path, chunks):
+    """
+    Yield `chunks` while writing them to `path`. The file is written to a
+    temporary name and moved in place only once complete, replacing the
+    artifacts of older versions of the resource in the same format.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                yield chunk
+        _remove_artifacts(directory, os.path.basename(path).split('-')[0] + '-', keep=path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _remove_artifacts(directory, prefix, keep=None):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path != keep and name.startswith(prefix) and not name.endswith('.tmp'):
+            try:
+                os.remove(path)
+            except OSError as e:
+                log.warn("Could not remove stale RDF artifact " + path + ": " + str(e))
+
+
+def status_path(resource_id, file_format):
+    path = artifacts_path()
+    if path is None:
+        return None
+    return os.path.join(path, resource_id, file_format + '.status.json')
+
+
+def read_status(resource_id, file_format):
+    """
+    Return the status of the last background export of the resource in
+    `file_format` (see jobs.build_rdf_artifact), or None.
+    """
+    path = status_path(resource_id, file_format)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (TypeError, IOError, ValueError):
+        return None
+
+
+def write_status(resource_id, file_format, **status):
+    """
+    Replace the status of the background export, returns it. Readers never
+    see a partially written file.
+    """
+    path = status_path(resource_id, file_format)
+    if path is None:
+        return None
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    status['updated'] = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+    return status
@@ -0,0 +1,16 @@
+import ckan.plugins.toolkit as toolkit
+from ckan.common import _
+
+
+def export_rdf(context, data_dict):
+    # background exports take worker time, only for the editors of the
+    # resource (sysadmins are always authorized)
+    try:
+        toolkit.check_access('resource_update', context, {'id': data_dict.get('resource_id')})
+    except toolkit.NotAuthorized:
+        return {
+            'success': False,
+            'msg': _(u'User {0} not authorized to export resource {1}').format(
+                context.get('user'), data_dict.get('resource_id')),
+        }
+    return {'success': True}
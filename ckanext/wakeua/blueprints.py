@@ -1,16 +1,27 @@
-from flask import Blueprint, make_response
-from ckan.plugins.toolkit import (request, abort, ObjectNotFound)
+import time
+
+from flask import Blueprint, Response, send_file, stream_with_context
+from ckan.plugins.toolkit import (request, abort, ObjectNotFound, _)
 import ckan.lib.base as base
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.navl.dictization_functions as dict_fns
-from ckanext.datastore.blueprint import dump_schema
-from ckanext.wakeua.logic import convert_resource_data
+from ckan.logic import parse_params, tuplize_dict
+from ckanext.datastore.blueprint import dump_schema, DictionaryView
+from ckanext.wakeua.logic import convert_resource_data, export_metadata, RDF_FORMATS
+from ckanext.wakeua import action
+from ckanext.wakeua import artifacts
+from ckanext.wakeua import delta
+from ckanext.wakeua import jobs
+from ckanext.wakeua import metrics
 
 from logging import getLogger
 
 log = getLogger(__name__)
 
+# seconds clients are asked to wait for the snapshot of a delta export
+SNAPSHOT_RETRY_AFTER = 30
+
 
 def get_blueprints(name, module):
     # Create Blueprint for plugin
@@ -28,15 +39,51 @@ def get_blueprints(name, module):
         wakeua_export_resource_data
     )
 
+    blueprint.add_url_rule(
+        u"/dataset/<id>/wakeua_dictionary/<resource_id>",
+        view_func=WakeuaDictionaryView.as_view(str(u"dictionary"))
+    )
+
+    blueprint.add_url_rule(
+        u"/wakeua/metrics",
+        u"wakeua_metrics",
+        wakeua_metrics
+    )
+
     return blueprint
 
 
 def legal_notice():
     return base.render('wakeua/legal_notice.html')
 
+class WakeuaDictionaryView(DictionaryView):
+    """
+    Data dictionary form showing the errors of the ontology mappings next
+    to their fields, instead of failing to save.
+    """
+
+    def post(self, id, resource_id):
+        try:
+            return super(WakeuaDictionaryView, self).post(id, resource_id)
+        except toolkit.ValidationError as e:
+            data_dict = self._prepare(id, resource_id)
+            # keep what was typed in the form
+            data = dict_fns.unflatten(tuplize_dict(parse_params(request.form)))
+            for field, info in zip(data_dict[u'fields'], data.get(u'info') or []):
+                if isinstance(info, dict):
+                    field[u'info'] = info
+            data_dict[u'errors'] = e.error_dict
+            data_dict[u'error_summary'] = {
+                field_id: u'; '.join(messages) for field_id, messages in e.error_dict.items()}
+            return base.render(u'datastore/dictionary.html', data_dict)
+
+
 def wakeua_export_resource_data(resource_id, file_format):
 
-    data, errors = dict_fns.validate(request.args.to_dict(), dump_schema())
+    args = request.args.to_dict()
+    # data version of a previous export, to get only what changed since then
+    since = args.pop(u'since', None)
+    data, errors = dict_fns.validate(args, dump_schema())
 
     if errors:
         abort(
@@ -51,16 +98,32 @@ def wakeua_export_resource_data(resource_id, file_format):
         'user': toolkit.g.user
     }
 
-    response = make_response()
-    response.headers[u'content-type'] = (b'application/x-turtle; charset=utf-8')
-    response.headers[u'Content-Disposition'] = 'attachment; filename=' + resource_id + '_' + file_format + '.ttl'
+    rdf_format = RDF_FORMATS.get(file_format)
+    if rdf_format is None or rdf_format['internal']:
+        abort(404, _(u'RDF format unknown'))
+    filename = resource_id + '_' + file_format + '.' + rdf_format['extension']
 
+    artifact = None
     try:
-        convert_resource_data(
+        metadata = export_metadata(context, resource_id)
+        version = artifacts.data_version(*metadata)
+        if since:
+            return _delta_response(context, resource_id, rdf_format, data, metadata, since, version)
+        if artifacts.is_cacheable(data):
+            # the version handed to the client must be usable as `since`
+            _ensure_snapshot(resource_id, version)
+            key = artifacts.artifact_key(file_format, *metadata)
+            cached = artifacts.get_artifact(resource_id, file_format, key, rdf_format['extension'])
+            if cached:
+                response = _send_artifact(cached, rdf_format['content_type'], filename)
+                response.headers[u'X-Data-Version'] = version
+                return response
+            artifact = artifacts.artifact_path(resource_id, file_format, key, rdf_format['extension'])
+
+        chunks = convert_resource_data(
             resource_id,
             file_format,
             context,
-            response,
             offset=data[u'offset'],
             limit=data.get(u'limit'),
             sort=data[u'sort'],
@@ -71,8 +134,88 @@ def wakeua_export_resource_data(resource_id, file_format):
                     u'filters', u'q', u'distinct', u'plain', u'language',
                     u'fields'
                 ]
-            }
+            },
+            metadata=metadata
         )
     except ObjectNotFound:
         abort(404, _(u'DataStore resource not found'))
+
+    if artifact:
+        # materialize the export while streaming it
+        chunks = artifacts.write_artifact(artifact, chunks)
+
+    response = Response(stream_with_context(chunks))
+    response.headers[u'content-type'] = rdf_format['content_type']
+    # only stored exports can be resumed, see the wakeua_export_rdf action
+    response.headers[u'Accept-Ranges'] = u'none'
+    response.headers[u'Content-Disposition'] = 'attachment; filename=' + filename
+    # pass it as `since` to get the next changes only
+    response.headers[u'X-Data-Version'] = version
+    return response
+
+
+def _delta_response(context, resource_id, rdf_format, data, metadata, since, version):
+    # RDF Patch with the triples added and removed since the `since` version
+    if not artifacts.is_cacheable(data):
+        abort(400, _(u'since can only be used to export the whole resource'))
+    if artifacts.artifacts_path() is None:
+        abort(400, _(u'RDF exports storage is not configured'))
+    old = delta.get_snapshot(resource_id, since)
+    if old is None:
+        abort(410, _(u'Data version not available, export the whole resource again'))
+    new = delta.get_snapshot(resource_id, version)
+    if new is None:
+        # converting the whole resource would outlast the request
+        _enqueue_snapshot(resource_id, version)
+        response = Response(_(u'The changes are being computed, try again later'), status=503)
+        response.headers[u'Retry-After'] = str(SNAPSHOT_RETRY_AFTER)
+        response.headers[u'X-Data-Version'] = version
+        return response
+
+    chunks = delta.rdf_patch(old, new, since, version, compress=rdf_format.get('compress'))
+    filename = u'{0}_{1}.rdfp'.format(resource_id, version)
+    content_type = delta.PATCH_CONTENT_TYPE
+    if rdf_format.get('compress'):
+        filename += u'.gz'
+        content_type = rdf_format['content_type']
+
+    response = Response(stream_with_context(chunks))
+    response.headers[u'content-type'] = content_type
+    response.headers[u'Content-Disposition'] = 'attachment; filename=' + filename
+    response.headers[u'X-Data-Version'] = version
+    return response
+
+
+def _ensure_snapshot(resource_id, version):
+    if artifacts.artifacts_path() and delta.get_snapshot(resource_id, version) is None:
+        _enqueue_snapshot(resource_id, version)
+
+
+def _enqueue_snapshot(resource_id, version):
+    # one job per version, unless the previous one seems lost
+    status = artifacts.read_status(resource_id, delta.SNAPSHOT_FORMAT) or {}
+    if status.get('key') == version and time.time() - status.get('updated', 0) < action.EXPORT_STALE_AFTER:
+        return
+    artifacts.write_status(resource_id, delta.SNAPSHOT_FORMAT, state='pending', key=version)
+    toolkit.enqueue_job(jobs.build_snapshot, [resource_id], title='wakeua RDF snapshot ' + resource_id)
+
+
+def _send_artifact(path, content_type, filename):
+    # conditional responses handle ETag, Last-Modified and Range requests
+    try:
+        return send_file(path, mimetype=content_type, as_attachment=True,
+                         download_name=filename, conditional=True)
+    except TypeError:
+        # Flask < 2.0
+        return send_file(path, mimetype=content_type, as_attachment=True,
+                         attachment_filename=filename, conditional=True)
+
+
+def wakeua_metrics():
+    # Prometheus scrape endpoint, the metrics are those of the web worker
+    # process answering the request
+    if not toolkit.asbool(toolkit.config.get('ckanext.wakeua.metrics.enabled', False)):
+        abort(404)
+    response = Response(metrics.render())
+    response.headers[u'content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
     return response
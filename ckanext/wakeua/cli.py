@@ -0,0 +1,252 @@
+import datetime
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+import ckan.lib.search as search
+from ckan.lib.search.common import make_connection
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckanext.datastore.backend import postgres as datastore_postgres
+from ckanext.wakeua import jobs
+from ckanext.wakeua import logic
+from ckanext.wakeua import metrics
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# packages fetched per package_search call
+PACKAGES_BATCH = 500
+
+# formats that can be concatenated into a merged dump (no header or footer)
+DUMP_FORMATS = {
+    'nt': 'rdf_segittur_nt_gz',
+    'nq': 'rdf_segittur_nq_gz',
+}
+
+
+def get_commands():
+    return [wakeua]
+
+
+@click.group(short_help=u"ckanext-wakeua commands")
+def wakeua():
+    pass
+
+
+@wakeua.command(u"export-rdf")
+@click.option(u"-o", u"--organization", multiple=True, help=u"Export the resources of this organization.")
+@click.option(u"-p", u"--package", multiple=True, help=u"Export the resources of this package (name or id).")
+@click.option(u"-a", u"--all", u"all_resources", is_flag=True, help=u"Export every datastore resource.")
+@click.option(u"-f", u"--format", u"dump_format", type=click.Choice(sorted(DUMP_FORMATS)), default=u"nq",
+              show_default=True, help=u"N-Quads keep each resource in its own graph.")
+@click.option(u"-d", u"--output", required=True, type=click.Path(file_okay=False),
+              help=u"Directory where the dump is written.")
+@click.option(u"-m", u"--merge", is_flag=True, help=u"Write a single dump file instead of one per resource.")
+@click.option(u"-w", u"--workers", type=int, default=os.cpu_count(), show_default=True,
+              help=u"Resources converted in parallel.")
+def export_rdf(organization, package, all_resources, dump_format, output, merge, workers):
+    u"""Dump the datastore data of many resources as gzipped RDF.
+    """
+    if not (organization or package or all_resources):
+        raise click.UsageError(u"Pass --organization, --package or --all")
+
+    file_format = DUMP_FORMATS[dump_format]
+    extension = logic.RDF_FORMATS[file_format]['extension']
+    context = jobs._site_context()
+    datastore_ids = set(toolkit.get_action('wakeua_list_datastore_resources')(dict(context), {}))
+    resources = list(_resources_to_export(context, datastore_ids, organization, package))
+    click.echo(u"Exporting {0} resources with {1} workers".format(len(resources), workers))
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    start = time.time()
+    rows = 0
+    paths = []
+    # forked workers inherit the loaded CKAN config and plugins
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_worker) as pool:
+        tasks = [(resource, package_dict, file_format, os.path.join(output, resource['id'] + '.' + extension))
+                 for resource, package_dict in resources]
+        # results come in order, so the merged dump is reproducible
+        for (resource, package_dict, _, path), (stats, error) in zip(tasks, pool.map(_export_resource, tasks)):
+            if error:
+                click.secho(u"{0}: {1}".format(resource['id'], error), fg=u"red")
+                continue
+            rows += stats.rows
+            paths.append(path)
+            click.echo(u"{0} ({1}): {2} rows, {3} triples, {4} bytes".format(
+                resource['id'], package_dict['name'], stats.rows, stats.triples, stats.bytes))
+
+    if merge:
+        # gzip members can be concatenated into a single gzip file
+        merged = os.path.join(output, u"wakeua-dump." + extension)
+        with open(merged + '.tmp', 'wb') as out:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(path)
+        os.replace(merged + '.tmp', merged)
+        click.echo(u"Merged dump written to " + merged)
+
+    elapsed = time.time() - start
+    click.secho(u"Exported {0} of {1} resources, {2} rows in {3:.1f}s ({4:.0f} rows/s)".format(
+        len(paths), len(resources), rows, elapsed, rows / elapsed if elapsed else 0), fg=u"green")
+
+
+def _resources_to_export(context, datastore_ids, organizations, packages):
+    # (resource, package) pairs of the selected datastore resources, with
+    # the metadata of many packages fetched in each package_search call
+    fq = []
+    if organizations:
+        fq.append(u'organization:({0})'.format(u' OR '.join(organizations)))
+    if packages:
+        fq.append(u'name:({0}) OR id:({0})'.format(u' OR '.join(packages)))
+    start = 0
+    while True:
+        result = toolkit.get_action('package_search')(dict(context), {
+            'fq': u' OR '.join(u'({0})'.format(q) for q in fq) if fq else u'',
+            'rows': PACKAGES_BATCH,
+            'start': start,
+            'sort': u'id asc',
+            'include_private': True,
+        })
+        for package_dict in result['results']:
+            for resource in package_dict.get('resources', []):
+                if resource['id'] in datastore_ids:
+                    yield resource, package_dict
+        start += PACKAGES_BATCH
+        if start >= result['count']:
+            break
+
+
+def _init_worker():
+    # connections opened before forking can't be shared with the parent
+    model.Session.remove()
+    model.meta.engine.dispose()
+    for engine in getattr(datastore_postgres, '_engines', {}).values():
+        engine.dispose()
+    # each resource is converted in one process, don't start more
+    toolkit.config[logic.EXPORT_WORKERS] = 0
+
+
+def _export_resource(task):
+    resource, package_dict, file_format, path = task
+    context = jobs._site_context()
+    stats = metrics.ExportStats(resource['id'], file_format)
+    try:
+        datastore_info = [
+            f for f in toolkit.get_action('datastore_search')(
+                dict(context), {'resource_id': resource['id'], 'limit': 0})['fields']
+            if not f['id'].startswith('_')]
+        chunks = logic.convert_resource_data(
+            resource['id'], file_format, context, offset=0, limit=None, sort=u'_id', search_params={},
+            metadata=(resource, package_dict, datastore_info), stats=stats)
+        with open(path + '.tmp', 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(path + '.tmp', path)
+        return stats, None
+    except Exception as e:
+        log.exception(e)
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        return stats, str(e)
+    finally:
+        model.Session.remove()
+
+
+@wakeua.command(u"reindex")
+@click.option(u"-s", u"--since", type=click.DateTime(),
+              help=u"Reindex the datasets modified since this date instead of comparing with the index.")
+@click.option(u"-b", u"--batch-size", type=int, default=100, show_default=True,
+              help=u"Datasets indexed by each worker task.")
+@click.option(u"-w", u"--workers", type=int, default=os.cpu_count(), show_default=True,
+              help=u"Datasets indexed in parallel.")
+@click.option(u"-n", u"--dry-run", is_flag=True, help=u"Only show what would be reindexed.")
+def reindex(since, batch_size, workers, dry_run):
+    u"""Update the search index of the datasets changed since they were indexed.
+    """
+    start = time.time()
+    modified = _modified_datasets()
+    if since:
+        changed = sorted(package_id for package_id, metadata_modified in modified.items()
+                         if metadata_modified >= since)
+        removed = []
+    else:
+        indexed = _indexed_datasets()
+        changed = sorted(package_id for package_id, metadata_modified in modified.items()
+                         if package_id not in indexed or _to_millis(metadata_modified) > indexed[package_id])
+        removed = sorted(set(indexed) - set(modified))
+    click.echo(u"{0} datasets to reindex, {1} to remove from the index".format(len(changed), len(removed)))
+    if dry_run:
+        return
+
+    for package_id in removed:
+        search.clear(package_id)
+    batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_worker) as pool:
+        done = 0
+        for count in pool.map(_reindex_batch, batches):
+            done += count
+            click.echo(u"Indexed {0}/{1}".format(done, len(changed)))
+    # a single commit, the workers don't commit after each dataset
+    search.commit()
+    click.secho(u"Reindexed {0} datasets in {1:.1f}s".format(len(changed), time.time() - start), fg=u"green")
+
+
+def _modified_datasets():
+    # {id: metadata_modified} of the datasets in the database, search.rebuild
+    # indexes all but the deleted ones (drafts too)
+    query = model.Session.query(model.Package.id, model.Package.metadata_modified).filter(
+        model.Package.state != u'deleted')
+    return dict(query)
+
+
+def _indexed_datasets():
+    # {id: metadata_modified} of the datasets of this site in the index
+    conn = make_connection()
+    indexed = {}
+    cursor = u'*'
+    while True:
+        # cursors need the sort to include the uniqueKey (index_id)
+        results = conn.search(
+            u'*:*', fq=u'+site_id:"{0}" +entity_type:package'.format(toolkit.config.get('ckan.site_id')),
+            fl=u'id,metadata_modified', sort=u'index_id asc', rows=5000, cursorMark=cursor)
+        for doc in results.docs:
+            indexed[doc['id']] = _to_millis(_solr_datetime(doc.get('metadata_modified')))
+        if results.nextCursorMark in (None, cursor):
+            break
+        cursor = results.nextCursorMark
+    return indexed
+
+
+def _solr_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    value = value.rstrip(u'Z')
+    try:
+        return datetime.datetime.strptime(value, u'%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(value, u'%Y-%m-%dT%H:%M:%S')
+
+
+def _to_millis(value):
+    # the index keeps dates with millisecond precision
+    if value is None:
+        return datetime.datetime.min
+    return value.replace(tzinfo=None, microsecond=value.microsecond // 1000 * 1000)
+
+
+def _reindex_batch(package_ids):
+    try:
+        search.rebuild(package_ids=package_ids, defer_commit=True, force=True, quiet=True)
+        return len(package_ids)
+    finally:
+        model.Session.remove()
@@ -0,0 +1,178 @@
+import gzip
+import os
+import re
+import tempfile
+from itertools import groupby
+
+from ckan.plugins.toolkit import config, asint
+from ckanext.wakeua import artifacts
+from ckanext.wakeua import logic
+from ckanext.wakeua.serializers import TRAILER_CHUNK_SIZE
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# internal export format of the snapshots, see serializers.SnapshotSerializer
+SNAPSHOT_FORMAT = 'rdf_segittur_snapshot_gz'
+
+# snapshots kept per resource, the older versions can't be used with `since`
+SNAPSHOTS_KEPT = 'ckanext.wakeua.delta.snapshots_kept'
+
+SNAPSHOTS_DIR = 'snapshots'
+
+PATCH_CONTENT_TYPE = 'application/rdf-patch; charset=utf-8'
+
+# data versions are sha1 hex digests, see artifacts.data_version
+_VERSION = re.compile(r'^[0-9a-f]{40}$')
+
+
+def snapshot_path(resource_id, version):
+    path = artifacts.artifacts_path()
+    if path is None:
+        return None
+    return os.path.join(path, resource_id, SNAPSHOTS_DIR, version + '.snapshot.gz')
+
+
+def get_snapshot(resource_id, version):
+    """
+    Return the path of the snapshot of the resource data at `version` (see
+    artifacts.data_version), or None if it is not there.
+    """
+    if not _VERSION.match(version or ''):
+        return None
+    path = snapshot_path(resource_id, version)
+    if path and os.path.isfile(path):
+        return path
+    return None
+
+
+def build_snapshot(resource_id, context, metadata=None):
+    """
+    Store the snapshot of the current version of the resource data: the
+    triples of each record and their hash, sorted by record identifier.
+    Returns its path, or None if the site has no local storage.
+    """
+    metadata = metadata or logic.export_metadata(context, resource_id)
+    version = artifacts.data_version(*metadata)
+    path = snapshot_path(resource_id, version)
+    if path is None or os.path.isfile(path):
+        return path
+
+    chunks = logic.convert_resource_data(
+        resource_id, SNAPSHOT_FORMAT, context, offset=0, limit=None, sort=u'_id', search_params={},
+        metadata=metadata)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _remove_old_snapshots(directory)
+    log.info("Stored snapshot " + version + " of resource " + resource_id)
+    return path
+
+
+def _remove_old_snapshots(directory):
+    kept = max(1, asint(config.get(SNAPSHOTS_KEPT, 5)))
+    snapshots = sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.snapshot.gz')),
+        key=os.path.getmtime, reverse=True)
+    for path in snapshots[kept:]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            log.warn("Could not remove old snapshot " + path + ": " + str(e))
+
+
+def _records(path):
+    # (sort key, hashes, lines) of each record of a snapshot, a record has
+    # more than one line when rows of different pages share its identifier
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = (line.rstrip(u'\n').split(u'\t', 2) for line in f)
+        for key, group in groupby(lines, key=lambda line: line[0]):
+            group = list(group)
+            # lines are sorted with the tab that follows the identifier
+            yield key + u'\t', [line[1] for line in group], group
+
+
+def _triples(record):
+    triples = {}
+    for line in record[2]:
+        for triple in line[2].split(u'\t'):
+            triples[triple] = None
+    return triples
+
+
+def diff_snapshots(old_path, new_path):
+    """
+    Yield ('D', triple) for the N-Triples (without the final " .") of the
+    old snapshot missing from the new one and ('A', triple) for the new
+    ones. Both snapshots are read once, in order; only the triples of the
+    records whose hash changed are compared.
+    """
+    old_records = _records(old_path)
+    new_records = _records(new_path)
+    old = next(old_records, None)
+    new = next(new_records, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            # removed record
+            for triple in _triples(old):
+                yield 'D', triple
+            old = next(old_records, None)
+        elif old is None or new[0] < old[0]:
+            # added record
+            for triple in _triples(new):
+                yield 'A', triple
+            new = next(new_records, None)
+        else:
+            if old[1] != new[1]:
+                old_triples = _triples(old)
+                new_triples = _triples(new)
+                for triple in old_triples:
+                    if triple not in new_triples:
+                        yield 'D', triple
+                for triple in new_triples:
+                    if triple not in old_triples:
+                        yield 'A', triple
+            old = next(old_records, None)
+            new = next(new_records, None)
+
+
+def rdf_patch(old_path, new_path, old_version, new_version, compress=False):
+    """
+    Yield the changes between two snapshots as an RDF Patch
+    (https://afs.github.io/rdf-delta/rdf-patch.html) in a single
+    transaction, with the data versions as patch id and previous id.
+    Chunks are gzip compressed bytes if `compress`.
+    """
+    chunks = _rdf_patch(old_path, new_path, old_version, new_version)
+    if compress:
+        return logic._gzip(chunks)
+    return chunks
+
+
+def _rdf_patch(old_path, new_path, old_version, new_version):
+    chunk = [
+        u'H id <urn:wakeua:version:{0}> .\n'.format(new_version),
+        u'H prev <urn:wakeua:version:{0}> .\n'.format(old_version),
+        u'TX .\n',
+    ]
+    size = 0
+    for operation, triple in diff_snapshots(old_path, new_path):
+        line = u'{0} {1} .\n'.format(operation, triple)
+        chunk.append(line)
+        size += len(line)
+        if size >= TRAILER_CHUNK_SIZE:
+            yield u''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(u'TC .\n')
+    yield u''.join(chunk)
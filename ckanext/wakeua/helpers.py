@@ -1,10 +1,44 @@
 
 import json
+import time
+from functools import lru_cache
 import ckan.plugins.toolkit as toolkit
 from ckan.common import config
 import ckan.lib.helpers as h
 from ckan.common import _
 
+# parsed multilingual JSON values kept in memory, keyed by the raw string
+JSON_CACHE_SIZE = 4096
+
+translation_cache_stats = {'hits': 0, 'misses': 0}
+
+# seconds the tags of a vocabulary are cached for
+VOCABULARY_TAGS_TTL = 'ckanext.wakeua.vocabulary_tags.cache_ttl'
+
+# {vocabulary: (expires, tags or None, {lang: [tag dicts]})}, cleared by the
+# tag and vocabulary actions (see action.py)
+_vocabulary_tags_cache = {}
+
+
+def wakeua_locale_order():
+    # ckan.locale_order is a space separated string in the ini file
+    value = config.get('ckan.locale_order') or ''
+    return _locale_order(tuple(value) if isinstance(value, list) else value)
+
+
+@lru_cache(maxsize=8)
+def _locale_order(value):
+    return tuple(toolkit.aslist(value)) or ("es",)
+
+
+@lru_cache(maxsize=JSON_CACHE_SIZE)
+def _split_tag(name, langs):
+    # "playa-es" -> ("playa", "es"), (name, None) if not language suffixed
+    base, _sep, lang = name.rpartition('-')
+    if base and lang in langs:
+        return base, lang
+    return name, None
+
 
 def wakeua_dataset_display_name(package_or_package_dict):
     if isinstance(package_or_package_dict, dict):
@@ -33,9 +67,8 @@ def wakeua_resource_display_name(resource_dict):
 
 def wakeua_extract_lang_value(field):
     if isinstance(field, dict):
-        LANGS = config.get('ckan.locale_order') or ["es"]
         lang_code = toolkit.request.environ['CKAN_LANG']
-        default_lang = LANGS[0]
+        default_lang = wakeua_locale_order()[0]
         translated_field = field.get(lang_code, None)
         if not translated_field:
             translated_field = field.get(default_lang, None)
@@ -52,9 +85,26 @@ def wakeua_get_translated(data_dict, field):
 
 
 def wakeua_force_translate(text):
+    if isinstance(text, str):
+        return _translate_text(text)
     return wakeua_extract_lang_value(to_json_dict_safe(text))
 
 
+def _translate_text(text):
+    # the same titles are translated many times when rendering a page,
+    # keep the results for the current request and language
+    environ = toolkit.request.environ
+    cache = environ.setdefault('wakeua.translations', {})
+    key = (text, environ['CKAN_LANG'])
+    try:
+        value = cache[key]
+        translation_cache_stats['hits'] += 1
+    except KeyError:
+        value = cache[key] = wakeua_extract_lang_value(to_json_dict_safe(text))
+        translation_cache_stats['misses'] += 1
+    return value
+
+
 def wakeua_markdown_extract(text, extract_length=190):
     if not text:
         return ''
@@ -65,7 +115,7 @@ def wakeua_markdown_extract(text, extract_length=190):
 
 
 def wakeua_truncate(text, length=30, indicator='...'):
-    string_text = wakeua_extract_lang_value(to_json_dict_safe(text))
+    string_text = wakeua_force_translate(text)
     if len(string_text) > length+3:
         return string_text[0:length]+indicator
     else:
@@ -75,30 +125,66 @@ def wakeua_truncate(text, length=30, indicator='...'):
 def to_json_dict_safe(text_input):
     if isinstance(text_input, str):
         if text_input.startswith('{'):
-            try:
-                json_dict = json.loads(text_input)
-            except ValueError as e:
+            json_dict = _parse_json(text_input)
+            if json_dict is None:
                 return text_input
-            return json_dict
+            # callers may modify the result, don't hand out the cached dict
+            return dict(json_dict) if isinstance(json_dict, dict) else json_dict
     return text_input
 
 
+@lru_cache(maxsize=JSON_CACHE_SIZE)
+def _parse_json(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def wakeua_cache_stats():
+    """
+    Hit/miss counters of the multilingual value caches of this process.
+    """
+    json_info = _parse_json.cache_info()
+    return {
+        'json': {'hits': json_info.hits, 'misses': json_info.misses, 'size': json_info.currsize},
+        'translations': dict(translation_cache_stats),
+    }
+
+
 def wakeua_link_to(label, url, **attrs):
-    string_label = wakeua_extract_lang_value(to_json_dict_safe(label))
+    string_label = wakeua_force_translate(label)
     return h.link_to(string_label, url, **attrs)
 
 
 def wakeua_list_dict_filter(list_, search_field, output_field, value):
-    for item in list_:
-        if item.get(search_field) == value:
-            output_value = wakeua_force_translate(item.get(output_field, value))
-            if output_value == item.get(output_field):
-                if output_value.rsplit('-', 1)[-1] in config.get('ckan.locale_order', ["es"]):
-                    output_value = wakeua_tag_display_name(output_value)
-            return output_value
-    if len(list_) == 0 and value.rsplit('-', 1)[-1] in config.get('ckan.locale_order', ["es"]):
-        return value.rsplit('-', 1)[0]
-    return value
+    if len(list_) == 0:
+        return _split_tag(value, wakeua_locale_order())[0]
+    return _facet_index(list_, search_field, output_field).get(value, value)
+
+
+def _facet_index(list_, search_field, output_field):
+    """
+    Return a {item[search_field]: display label} dict of a list of facet
+    items (translated, language suffix of tags removed). It is built once
+    per request and list, the search page looks up every active filter.
+    """
+    indexes = toolkit.request.environ.setdefault('wakeua.facet_indexes', {})
+    key = (id(list_), search_field, output_field)
+    # the list is kept along its index so its id can't be reused
+    if key not in indexes or indexes[key][0] is not list_:
+        langs = wakeua_locale_order()
+        labels = {}
+        for item in list_:
+            value = item.get(search_field)
+            if value in labels:
+                continue
+            label = wakeua_force_translate(item.get(output_field, value))
+            if label == item.get(output_field) and isinstance(label, str):
+                label = _split_tag(label, langs)[0]
+            labels[value] = label
+        indexes[key] = (list_, labels)
+    return indexes[key][1]
 
 
 def wakeua_render_markdown(data, auto_link=True, allow_html=False):
@@ -115,46 +201,82 @@ def wakeua_tag_display_name(name):
 
 
 def wakeua_extract_tags(tags):
-    langs = config.get('ckan.locale_order') or ["es"]
-
-    # get all languages tags
-    new_tags = [tag for tag in tags if tag.get("name", "").rsplit('-', 1)[-1] not in langs]
-
-    # get translated tags
+    langs = wakeua_locale_order()
     lang_code = toolkit.request.environ['CKAN_LANG']
-    suffix = "-" + lang_code
-    sel_tags = [tag for tag in tags if tag.get("name", "").endswith(suffix)] # translated tag
 
-    for tag in sel_tags:
-        tag["display_name"] = wakeua_tag_display_name(tag["name"])
-        new_tags += [tag]
+    # all languages tags, then the tags translated to the current language
+    new_tags = []
+    sel_tags = []
+    for tag in tags:
+        display_name, lang = _split_tag(tag.get("name", ""), langs)
+        if lang is None:
+            new_tags.append(tag)
+        elif lang == lang_code:
+            tag["display_name"] = display_name
+            sel_tags.append(tag)
 
-    return new_tags
+    return new_tags + sel_tags
 
 
 def wakeua_get_facet_items_dict(facet, search_facets=None, limit=None, exclude_active=False):
-    facet_items_dict = h.get_facet_items_dict(facet, search_facets, limit, exclude_active)
-    if facet in ["tags", "schemaorg_tags"]:
-        return wakeua_extract_tags(facet_items_dict)
-    return facet_items_dict
+    # facet lists are sorted and filtered once per request, the templates
+    # ask for them several times
+    cache = toolkit.request.environ.setdefault('wakeua.facet_items', {})
+    key = (facet, id(search_facets), limit, exclude_active)
+    if key not in cache or cache[key][0] is not search_facets:
+        facet_items_dict = h.get_facet_items_dict(facet, search_facets, limit, exclude_active)
+        if facet in ["tags", "schemaorg_tags"]:
+            facet_items_dict = wakeua_extract_tags(facet_items_dict)
+        cache[key] = (search_facets, facet_items_dict)
+    return cache[key][1]
 
 
 def wakeua_get_vocabulary_tags(vocabulary):
-    try:
-        vocabulary_codes = toolkit.get_action('tag_list')(
-                data_dict={'vocabulary_id': vocabulary})
-        return vocabulary_codes
-    except toolkit.ObjectNotFound:
-        return None
+    return _vocabulary_tags(vocabulary)[1]
+
+
+def wakeua_get_vocabulary_lang_tags(vocabulary, lang=None):
+    """
+    Return the tags of the vocabulary in `lang` (by default the current
+    language), as {'name': 'playa-es', 'display_name': 'playa'} dicts.
+    """
+    lang = lang or toolkit.request.environ['CKAN_LANG']
+    return _vocabulary_tags(vocabulary)[2].get(lang, [])
+
+
+def _vocabulary_tags(vocabulary):
+    entry = _vocabulary_tags_cache.get(vocabulary)
+    if entry is None or entry[0] < time.time():
+        try:
+            tags = toolkit.get_action('tag_list')(
+                    data_dict={'vocabulary_id': vocabulary})
+        except toolkit.ObjectNotFound:
+            tags = None
+        # tags are "<name>-<lang>", split them by language once
+        langs = wakeua_locale_order()
+        lang_tags = {}
+        for tag in tags or []:
+            display_name, lang = _split_tag(tag, langs)
+            if lang:
+                lang_tags.setdefault(lang, []).append({"name": tag, "display_name": display_name})
+        ttl = toolkit.asint(config.get(VOCABULARY_TAGS_TTL, 300))
+        entry = _vocabulary_tags_cache[vocabulary] = (time.time() + ttl, tags, lang_tags)
+    return entry
+
+
+def clear_vocabulary_tags_cache():
+    _vocabulary_tags_cache.clear()
 
 
 def wakeua_show_dataset_vocabulary_tags(data):
     tags = []
+    lang_code = toolkit.request.environ['CKAN_LANG']
+    langs = wakeua_locale_order()
 
     for tag_string in data.split(','):
-        if tag_string.rsplit('-',1)[-1] == toolkit.request.environ['CKAN_LANG']:
-            new_tag = {"name": tag_string, "display_name": tag_string.rsplit('-', 1)[0]}
-            tags += [new_tag]
+        display_name, lang = _split_tag(tag_string.strip(), langs)
+        if lang == lang_code:
+            tags += [{"name": tag_string.strip(), "display_name": display_name}]
     return tags
 
 
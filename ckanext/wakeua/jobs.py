@@ -0,0 +1,169 @@
+import datetime
+import json
+import time
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckanext.wakeua import artifacts
+from ckanext.wakeua import delta
+from ckanext.wakeua import logic
+from ckanext.wakeua import metrics
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# seconds between updates of the status file of a running export
+STATUS_INTERVAL = 5
+
+# task_status where the last resource version submitted to xloader is kept
+XLOADER_TASK_TYPE = 'wakeua_xloader'
+
+# seconds after which an xloader job that didn't finish is considered lost
+XLOADER_STALE_AFTER = 3600
+
+
+def _site_context():
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': site_user['name'],
+        'ignore_auth': True,
+    }
+
+
+def build_rdf_artifact(resource_id, file_format='rdf_segittur'):
+    """
+    Background job materializing the whole RDF export of a resource, so the
+    export blueprint can serve it from disk. Its progress is kept in the
+    status file of the export, see action.export_rdf_status.
+    """
+    rdf_format = logic.RDF_FORMATS[file_format]
+    context = _site_context()
+    try:
+        metadata = logic.export_metadata(context, resource_id)
+        key = artifacts.artifact_key(file_format, *metadata)
+        path = artifacts.artifact_path(resource_id, file_format, key, rdf_format['extension'])
+        if path is None or artifacts.get_artifact(resource_id, file_format, key, rdf_format['extension']):
+            return
+
+        total = toolkit.get_action('datastore_search')(
+            dict(context), {'resource_id': resource_id, 'limit': 0, 'include_total': True})['total']
+        stats = metrics.ExportStats(resource_id, file_format)
+        chunks = logic.convert_resource_data(
+            resource_id, file_format, context, offset=0, limit=None, sort=u'_id', search_params={},
+            metadata=metadata, stats=stats)
+    except toolkit.ObjectNotFound:
+        log.warn("DataStore resource not found for the RDF export: " + resource_id)
+        return
+
+    def status(state, **kwargs):
+        return artifacts.write_status(resource_id, file_format, state=state, key=key, rows=stats.rows,
+                                      total_rows=total, bytes=stats.bytes, **kwargs)
+
+    status('running')
+    try:
+        reported = time.time()
+        for chunk in artifacts.write_artifact(path, chunks):
+            if time.time() - reported > STATUS_INTERVAL:
+                status('running')
+                reported = time.time()
+    except Exception as e:
+        status('error', error=str(e))
+        raise
+    status('complete')
+    log.info("Stored RDF export of resource " + resource_id + " in " + path)
+
+
+def build_snapshot(resource_id):
+    """
+    Background job storing the snapshot of the resource data the delta
+    exports (`since`) are computed from, see delta.py.
+    """
+    try:
+        delta.build_snapshot(resource_id, _site_context())
+    except toolkit.ObjectNotFound:
+        log.warn("DataStore resource not found for the snapshot: " + resource_id)
+
+
+def resource_fingerprint(resource):
+    """
+    Identify the version of the resource file. The hash is left out as
+    xloader sets it on the resource after loading the file.
+    """
+    return json.dumps([resource.get('url'), resource.get('last_modified'), resource.get('size')])
+
+
+def load_package_resources(resources):
+    """
+    Background job submitting to xloader the resources of a package that
+    changed since they were last loaded successfully (a load of the same
+    version in progress is waited for), and refreshing the RDF exports and
+    snapshots of the ones already loaded if their data version changed.
+    `resources` is a list of {'id', 'fingerprint', 'datastore_active'} dicts.
+    """
+    context = _site_context()
+    for resource in resources:
+        try:
+            state = _load_state(context, resource)
+            if state == 'submit':
+                toolkit.get_action('xloader_submit')(dict(context), {'resource_id': resource['id']})
+                toolkit.get_action('task_status_update')(dict(context), {
+                    'entity_id': resource['id'],
+                    'entity_type': 'resource',
+                    'task_type': XLOADER_TASK_TYPE,
+                    'key': 'fingerprint',
+                    'value': resource['fingerprint'],
+                    'state': 'submitted',
+                    'last_updated': datetime.datetime.utcnow().isoformat(),
+                })
+            elif state == 'loaded' and resource['datastore_active'] and artifacts.artifacts_path() \
+                    and not _exports_stored(context, resource['id']):
+                build_rdf_artifact(resource['id'])
+                build_snapshot(resource['id'])
+        except Exception as e:
+            log.error("Could not process resource " + resource['id'] + ": " + str(e))
+
+
+def _load_state(context, resource):
+    # 'loaded' if this version of the resource was loaded by xloader,
+    # 'loading' if its load is in progress and 'submit' otherwise (changed,
+    # failed or lost)
+    try:
+        task = toolkit.get_action('task_status_show')(dict(context), {
+            'entity_id': resource['id'], 'task_type': XLOADER_TASK_TYPE, 'key': 'fingerprint'})
+    except toolkit.ObjectNotFound:
+        return 'submit'
+    if task['value'] != resource['fingerprint']:
+        return 'submit'
+    try:
+        status = toolkit.get_action('xloader_status')(dict(context), {'resource_id': resource['id']})
+    except toolkit.ObjectNotFound:
+        return 'submit'
+    if status.get('status') == 'complete':
+        return 'loaded'
+    if status.get('status') in ('pending', 'submitting', 'running'):
+        updated = _parse_datetime(status.get('last_updated') or task.get('last_updated'))
+        if updated and (datetime.datetime.utcnow() - updated).total_seconds() < XLOADER_STALE_AFTER:
+            return 'loading'
+    return 'submit'
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime.datetime) or not value:
+        return value
+    try:
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _exports_stored(context, resource_id):
+    # whether the default export and the snapshot of the current data
+    # version are stored, nothing to rebuild then
+    rdf_format = logic.RDF_FORMATS['rdf_segittur']
+    metadata = logic.export_metadata(context, resource_id)
+    key = artifacts.artifact_key('rdf_segittur', *metadata)
+    return bool(artifacts.get_artifact(resource_id, 'rdf_segittur', key, rdf_format['extension'])
+                and delta.get_snapshot(resource_id, artifacts.data_version(*metadata)))
@@ -0,0 +1,97 @@
+"""
+Location of the organizations, added to every record of their RDF exports.
+
+It comes from organization_locations.json, loaded once at startup, and the
+location fields of the organizations themselves (see
+organization_schema.json), which take precedence. Both are indexed by
+organization name, so exports look their location up once.
+"""
+import json
+import os
+import time
+
+import ckan.model as model
+from ckan.plugins.toolkit import config, asint
+
+# location fields, in the order their triples are added
+LOCATION_FIELDS = ('country', 'autonomous_community', 'province', 'city')
+
+TABLE_PATH = os.path.join(os.path.dirname(__file__), 'organization_locations.json')
+
+# seconds the locations of the organizations are cached for
+LOCATIONS_TTL = 'ckanext.wakeua.locations.cache_ttl'
+
+# contents of organization_locations.json
+_table = {}
+
+# {'index': {name: location}, 'default': location, 'expires': timestamp},
+# cleared when an organization is created, updated or deleted
+_locations_cache = {}
+
+
+def load_table(path=TABLE_PATH):
+    """
+    Load the organization locations table, once per process.
+    """
+    with open(path) as f:
+        table = json.load(f)
+    _table.clear()
+    _table.update(table)
+    _locations_cache.clear()
+
+
+def _location(fields):
+    # ((field, value), ...) of the non empty fields, the city is only
+    # used along with the province
+    if not fields.get('province'):
+        fields = dict(fields, city=None)
+    return tuple((field, fields[field]) for field in LOCATION_FIELDS if fields.get(field))
+
+
+def index_locations(table, extras):
+    """
+    Return the location of each organization of `table` (the contents of
+    organization_locations.json) or `extras` ({name: {field: value}}), and
+    the location of the rest of organizations.
+    """
+    default = {'country': table.get('country')}
+    organizations = table.get('organizations') or {}
+    index = {}
+    for name in set(organizations) | set(extras):
+        fields = dict(default)
+        fields.update(organizations.get(name) or {})
+        fields.update((field, value) for field, value in (extras.get(name) or {}).items() if value)
+        index[name] = _location(fields)
+    return index, _location(default)
+
+
+def _organization_extras():
+    # {name: {field: value}} of the location fields of the organizations
+    query = model.Session.query(model.Group.name, model.GroupExtra.key, model.GroupExtra.value).join(
+        model.GroupExtra, model.GroupExtra.group_id == model.Group.id).filter(
+        model.Group.is_organization == True,  # noqa: E712
+        model.Group.state == u'active',
+        model.GroupExtra.state == u'active',
+        model.GroupExtra.key.in_(LOCATION_FIELDS))
+    extras = {}
+    for name, key, value in query:
+        extras.setdefault(name, {})[key] = (value or u'').strip()
+    return extras
+
+
+def organization_location(name):
+    """
+    Return the location of the organization as ((field, value), ...), in
+    the order of LOCATION_FIELDS.
+    """
+    cache = _locations_cache
+    if cache.get('expires', 0) < time.time():
+        if not _table:
+            load_table()
+        cache['index'], cache['default'] = index_locations(_table, _organization_extras())
+        cache['expires'] = time.time() + asint(config.get(LOCATIONS_TTL, 300))
+    return cache['index'].get(name, cache['default'])
+
+
+def clear_locations_cache():
+    _locations_cache.clear()
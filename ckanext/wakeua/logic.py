@@ -1,37 +1,79 @@
 import json
+import time
+import zlib
+from io import StringIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import count, islice, repeat, takewhile
 from contextlib import contextmanager
-from ckan.plugins.toolkit import (abort, get_action)
+from functools import partial
+import ckan.model as model
+from ckan.plugins.toolkit import (abort, get_action, _, config, asint)
 from ckanext.datastore import helpers as datastore_helpers
+from ckanext.datastore.backend import postgres as datastore_postgres
+import sqlalchemy as sa
 
-from rdflib import Graph, Literal, RDF, URIRef, BNode
-from rdflib.namespace import Namespace, RDF, XSD, SKOS, RDFS
+from ckanext.wakeua import locations
+from ckanext.wakeua import metrics
+from ckanext.wakeua import ontology
+from ckanext.wakeua import pushdown
+from ckanext.wakeua import serializers
 
-from unidecode import unidecode
-import re
+from rdflib import Graph, Literal, RDF
+from rdflib.namespace import Namespace, XSD
 
 from logging import getLogger
 
 log = getLogger(__name__)
 
 PAGINATE_BY = 32000
-PREDICATOR_SEP  = '/'
 
-# Create an RDF URI node to use as the subject for multiple triples
-BASEURI = "https://tdata.dlsi.ua.es/recurso/turismo/"
+# datastore pages fetched ahead of the conversion
+EXPORT_PREFETCH_PAGES = 'ckanext.wakeua.export.prefetch_pages'
+# processes converting pages to RDF, 0 to convert in the web worker
+EXPORT_WORKERS = 'ckanext.wakeua.export.workers'
 
 
-def convert_resource_data(resource_id, file_format, context, response, offset, limit, sort, search_params):
-
+def export_metadata(context, resource_id):
+    """
+    Return the (resource, package, datastore dictionary) metadata an export
+    of the resource depends on. Raises ObjectNotFound or NotAuthorized.
+    """
     resource_metadata = get_action('resource_show')(context, {'id': resource_id})
     package_metadata = get_action('package_show')(context, {'id': resource_metadata['package_id']})
 
     # get datastore info
     datastore_info = datastore_helpers.datastore_dictionary(resource_id)
+    return resource_metadata, package_metadata, datastore_info
+
+
+def convert_resource_data(resource_id, file_format, context, offset, limit, sort, search_params, metadata=None,
+                          stats=None):
+    """
+    Convert the datastore records of a resource to RDF.
+
+    Metadata lookups and the first datastore page are fetched eagerly, so
+    ObjectNotFound is raised before any output is produced. Returns a
+    generator of chunks (text, or bytes for the gzip formats): the header
+    first, then the triples of one datastore page at a time, so memory stays
+    bounded by one page. Timings and counts are added to the process metrics
+    (see metrics.py) once the generator is exhausted or closed.
+    `metadata` can be passed if already fetched with export_metadata, and
+    `stats` (a metrics.ExportStats) to follow the progress of the export.
+    """
+
+    resource_metadata, package_metadata, datastore_info = metadata or export_metadata(context, resource_id)
     records_format =  u'lists'
+    user = context.get('user')
 
-    def result_page(offs, lim):
+    id_column = ontology.mapped_columns(datastore_info)[0]
+    if id_column and not search_params.get(u'fields'):
+        # only the columns used by the ontology mapping are fetched
+        search_params = dict(search_params, fields=ontology.export_columns(datastore_info))
+
+    def result_page(offs, lim, search_context=None):
         return get_action(u'datastore_search')(
-            None,
+            search_context,
             dict({
                 u'resource_id': resource_id,
                 u'limit': PAGINATE_BY
@@ -43,7 +85,10 @@ def convert_resource_data(resource_id, file_format, context, response, offset, l
             }, **search_params)
         )
 
-    result = result_page(offset, limit)
+    if stats is None:
+        stats = metrics.ExportStats(resource_id, file_format)
+    result, seconds = _timed(result_page, offset, limit, {'user': user})
+    stats.fetch_seconds.append(seconds)
 
     if result[u'limit'] != limit:
         # `limit` (from PAGINATE_BY) must have been more than
@@ -54,268 +99,505 @@ def convert_resource_data(resource_id, file_format, context, response, offset, l
     else:
         paginate_by = PAGINATE_BY
 
-    if file_format == 'rdf_segittur':
-        rdf_writer = rdf_segittur_writer
+    if file_format in RDF_FORMATS:
+        rdf_format = RDF_FORMATS[file_format]
+        rdf_writer = rdf_format['writer']
+        serializer = rdf_format['serializer']
     else:
         abort(404, _(u'RDF format unknown'))
 
-    with rdf_writer(result[u'fields'], resource_metadata, package_metadata, datastore_info, response) as wr:
-        while True:
-            if limit is not None and limit <= 0:
-                break
-            records = result[u'records']
-
-            wr.write_records(records)
-
-            if len(records) < paginate_by:
-                break
-
-            offset += paginate_by
-            if limit is not None:
-                limit -= paginate_by
-                if limit <= 0:
+    prefetch_pages = max(1, asint(config.get(EXPORT_PREFETCH_PAGES, 2)))
+    workers = asint(config.get(EXPORT_WORKERS, 0))
+    # looked up once, the writers (also those of the workers) get it as data
+    location = locations.organization_location((package_metadata.get('organization') or {}).get('name'))
+
+    def fetch_records(offs):
+        # runs in the prefetch threads, outside of the request context
+        try:
+            lim = None if limit is None else limit - (offs - offset)
+            return result_page(offs, lim, {'user': user})[u'records']
+        finally:
+            model.Session.remove()
+
+    columns = [f[u'id'] for f in result[u'fields']]
+    keyset = _keyset_pagination(sort, search_params, columns)
+
+    # records without identifier produce no triples, whole exports skip them
+    # in the query (a `limit` counts every record)
+    skip_empty = id_column if limit is None and id_column in columns else None
+
+    sql_plan = None
+    unaccent = False
+    if keyset and skip_empty and pushdown.enabled():
+        plan = ontology.get_ontology_plan(resource_id, datastore_info, columns)
+        if plan is not None:
+            # the next pages come with the transforms already applied
+            unaccent = pushdown.has_unaccent()
+            sql_plan = pushdown.compile_sql_plan(plan, result[u'fields'], unaccent)
+
+    def keyset_records(last_id, lim):
+        try:
+            if sql_plan is not None:
+                return pushdown.SQLRecords(
+                    _records_after(resource_id, columns, last_id, lim, skip_empty, sql_plan.expressions))
+            return _records_after(resource_id, columns, last_id, lim, skip_empty)
+        finally:
+            model.Session.remove()
+
+    def keyset_pages(records):
+        # seek past the last _id of the previous page instead of using an
+        # OFFSET, fetching the next page while the current one is converted
+        id_index = columns.index(u'_id')
+        remaining = None if limit is None else limit - len(records)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            while True:
+                future = None
+                if len(records) >= paginate_by and (remaining is None or remaining > 0):
+                    lim = paginate_by if remaining is None else min(paginate_by, remaining)
+                    # _id comes first in the records transformed in SQL
+                    last_id = records[-1][0 if isinstance(records, pushdown.SQLRecords) else id_index]
+                    future = pool.submit(_timed, keyset_records, last_id, lim)
+                yield records
+                if future is None:
+                    break
+                records, seconds = future.result()
+                stats.fetch_seconds.append(seconds)
+                if remaining is not None:
+                    remaining -= len(records)
+
+    def pages():
+        records = result[u'records']
+        if len(records) < paginate_by:
+            yield records
+            return
+        if keyset:
+            for records in keyset_pages(records):
+                yield records
+            return
+        end = None if limit is None else offset + limit
+        offsets = takewhile(lambda offs: end is None or offs < end,
+                            count(offset + paginate_by, paginate_by))
+        with ThreadPoolExecutor(max_workers=prefetch_pages) as pool:
+            fetched = _ordered_map(pool, partial(_timed, fetch_records), offsets, prefetch_pages)
+            yield records
+            for records, seconds in fetched:
+                stats.fetch_seconds.append(seconds)
+                yield records
+                if len(records) < paginate_by:
                     break
-            result = result_page(offset, limit)
-
-
-@contextmanager
-def rdf_segittur_writer(fields, resource_metadata, package_metadata, datastore_info, response):
-    # Create a Graph
-    g = Graph()
-
-    # build ontology based dictionary
-    ontology_dict = {}
-    for field in datastore_info:
-        if len(field.get('info', {}).get('ontology', '')) > 0:
-            try:
-                ontology_infos = json.loads(field.get('info', {}).get('ontology', '').replace("'", '"'))
-                field_name = field['id']
-                for info in ontology_infos:
-                    ontology = info.get('ontology')
-                    predicate = info.get('predicate')
-                    prefix = info.get('predicate')
-                    if ontology and prefix and predicate:
-                        ontology_dict[(ontology, predicate)] = {'id': field_name, 'info': info}
-
-            except Exception as e:
-                log.warn("WARN: could not parse JSON from ontology info on field data: " + str(field) + "\n" + str(e))
 
-    prefixes = []
-    for key, item in ontology_dict.items():
-        prefix = item['info'].get('prefix')
-        predicate = item['info'].get('predicate')
-        if  prefix and predicate:
-            namespace_uri = item['info']['ontology']
-            namespace = Namespace(namespace_uri)
-            prefixes += [(prefix, Namespace(namespace_uri))]
+    def converted_pages(wr, stream):
+        if workers > 0:
+            # CPU bound conversion spread across processes, in order
+            with ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_convert_worker,
+                    initargs=(rdf_writer, serializer, result[u'fields'], resource_metadata,
+                              package_metadata, datastore_info, sql_plan is not None, unaccent,
+                              location)) as pool:
+                for chunk, errors, page_stats in _ordered_map(
+                        pool, _convert_page, pages(), workers + prefetch_pages):
+                    wr.errors.merge(errors)
+                    stats.merge(page_stats)
+                    yield chunk
+        else:
+            for records in pages():
+                wr.write_records(records)
+                yield _drain(stream)
+
+    def generate():
+        stream = StringIO()
+        with rdf_writer(result[u'fields'], resource_metadata, package_metadata, datastore_info, stream,
+                        serializer, location) as wr:
+            wr.stats = stats
+            stats.errors = wr.errors
+            if sql_plan is not None:
+                wr.sql_plan = sql_plan.plan
+            yield _drain(stream)
+            if limit is None or limit > 0:
+                first = True
+                for chunk in converted_pages(wr, stream):
+                    if wr.serializer.spooled:
+                        wr.serializer.spool(chunk)
+                    elif chunk:
+                        if not first:
+                            yield wr.serializer.separator
+                        first = False
+                        yield chunk
+                for chunk in wr.serializer.trailer():
+                    yield chunk
+        # footer
+        yield _drain(stream)
+
+    if rdf_format.get('compress'):
+        return _instrumented(_gzip(generate()), stats)
+    return _instrumented(generate(), stats)
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _instrumented(chunks, stats):
+    # count the bytes produced and record the export once it is over
+    completed = False
+    try:
+        for chunk in chunks:
+            stats.bytes += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode('utf-8'))
+            yield chunk
+        completed = True
+    finally:
+        metrics.record_export(stats, completed)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _keyset_pagination(sort, search_params, columns):
+    """
+    Whether the export can page by _id instead of by offset: records must be
+    sorted by _id, include it and not be filtered by datastore_search.
+    """
+    return (
+        (sort or u'_id').strip().lower() in (u'_id', u'_id asc', u'"_id"', u'"_id" asc')
+        and u'_id' in columns
+        and not any(search_params.get(k) for k in (u'q', u'filters', u'distinct'))
+    )
+
+
+def _records_after(resource_id, columns, last_id, limit, id_column=None, expressions=None):
+    """
+    Return up to `limit` records of the datastore table with an _id greater
+    than `last_id`, as lists of JSON values like datastore_search does.
+    Using the _id index keeps the cost of a page flat across the table.
+    Records with an empty `id_column` are left out if it is given, and
+    the JSON values of `expressions` are selected instead of `columns` if
+    they are (see pushdown.py).
+    """
+    if expressions is None:
+        expressions = [u'to_json({0})'.format(datastore_postgres.identifier(c)) for c in columns]
+    where = u'"_id" > :last_id'
+    if id_column:
+        where += u" AND nullif(btrim({0}::text), '') IS NOT NULL".format(datastore_postgres.identifier(id_column))
+    sql = u'''
+        SELECT coalesce(json_agg(j.v ORDER BY j._id), '[]')::text FROM (
+            SELECT "_id", array_to_json(ARRAY[{select}]) AS v FROM {table}
+            WHERE {where} ORDER BY "_id" LIMIT :limit
+        ) AS j'''.format(
+        select=u', '.join(expressions),
+        table=datastore_postgres.identifier(resource_id),
+        where=where,
+    )
+    with datastore_postgres.get_read_engine().connect() as conn:
+        records = conn.execute(sa.text(sql), {u'last_id': last_id, u'limit': limit}).scalar()
+    return json.loads(records)
+
+
+def datastore_resources():
+    """
+    Return a list of dicts, sorted by id, describing the active resources
+    that have a datastore table: id, package_id, owner_org, organization
+    (name), private, format, has_ontology (whether a data dictionary field
+    has an ontology mapping), rows (estimated by postgres, None if unknown)
+    and size (bytes of the table and its indexes). Only the catalogs of
+    the datastore and CKAN databases are read, no table is scanned.
+    """
+    sql = u'''
+        SELECT c.relname,
+               CASE WHEN c.reltuples < 0 THEN NULL ELSE c.reltuples::bigint END,
+               pg_total_relation_size(c.oid),
+               coalesce(bool_or(col_description(c.oid, a.attnum) ~ '"ontology": *"[^"]'), false)
+        FROM pg_class c
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE c.relkind = 'r'
+          AND c.relnamespace = 'public'::regnamespace
+          AND c.relname IN (SELECT name FROM "_table_metadata" WHERE alias_of IS NULL)
+        GROUP BY c.oid, c.relname, c.reltuples'''
+    with datastore_postgres.get_read_engine().connect() as conn:
+        tables = {row[0]: row[1:] for row in conn.execute(sa.text(sql))}
+
+    resources = []
+    ids = sorted(tables)
+    for i in range(0, len(ids), 1000):
+        query = model.Session.query(
+            model.Resource.id, model.Resource.format, model.Package.id, model.Package.owner_org,
+            model.Package.private, model.Group.name,
+        ).join(model.Package, model.Resource.package_id == model.Package.id).outerjoin(
+            model.Group, model.Package.owner_org == model.Group.id
+        ).filter(
+            model.Resource.id.in_(ids[i:i + 1000]),
+            model.Resource.state == u'active',
+            model.Package.state == u'active',
+        )
+        for resource_id, resource_format, package_id, owner_org, private, organization in query:
+            rows, size, has_ontology = tables[resource_id]
+            resources.append({
+                'id': resource_id,
+                'package_id': package_id,
+                'owner_org': owner_org,
+                'organization': organization,
+                'private': private,
+                'format': resource_format or u'',
+                'has_ontology': has_ontology,
+                'rows': rows,
+                'size': size,
+            })
+    return sorted(resources, key=lambda r: r['id'])
+
+
+def _ordered_map(executor, fn, iterable, depth):
+    """
+    Like executor.map, but consumes `iterable` lazily, keeping at most
+    `depth` calls in flight, and yields the results in order. The first
+    calls are submitted right away, before the results are iterated.
+    """
+    iterator = iter(iterable)
+    pending = deque(executor.submit(fn, item) for item in islice(iterator, depth))
+
+    def results():
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for item in islice(iterator, 1):
+                    pending.append(executor.submit(fn, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return results()
+
+
+# state of the conversion processes, see _init_convert_worker
+_worker = {}
+
+
+def _init_convert_worker(rdf_writer, serializer, fields, resource_metadata, package_metadata, datastore_info,
+                         sql_transforms=False, unaccent=False, location=()):
+    stream = StringIO()
+    _worker['writer_context'] = rdf_writer(fields, resource_metadata, package_metadata, datastore_info, stream,
+                                           serializer, location)
+    _worker['writer'] = _worker['writer_context'].__enter__()
+    if sql_transforms:
+        # same plan as the parent process, the transforms can't be pickled
+        _worker['writer'].sql_plan = pushdown.compile_sql_plan(_worker['writer'].plan, fields, unaccent).plan
+    _worker['stream'] = stream
+    # the header is written by the parent process
+    _drain(stream)
+
+
+def _convert_page(records):
+    writer = _worker['writer']
+    writer.errors = ontology.TransformErrors()
+    writer.stats = metrics.ExportStats()
+    writer.write_records(records)
+    return _drain(_worker['stream']), writer.errors, writer.stats
+
+
+def _drain(stream):
+    # return everything written so far and reset the buffer
+    chunk = stream.getvalue()
+    stream.seek(0)
+    stream.truncate(0)
+    return chunk
 
-    for prefix, namespace in set(prefixes):
-        g.bind(prefix, namespace)
 
-    yield RDFSegitturWriter(response.stream, [f[u'id'] for f in fields], ontology_dict, resource_metadata, package_metadata, g)
+@contextmanager
+def rdf_segittur_writer(fields, resource_metadata, package_metadata, datastore_info, stream,
+                        serializer=serializers.TurtleSerializer, location=()):
+    """
+    `location` is the ((field, value), ...) location of the organization,
+    see locations.organization_location.
+    """
+    columns = [f[u'id'] for f in fields]
+    plan = ontology.get_ontology_plan(resource_metadata.get('id'), datastore_info, columns)
+
+    # Graph used only for prefix bookkeeping, triples are never added to it.
+    # Only the prefixes the triples use are bound (rdf:type, xsd datatypes),
+    # not the ones rdflib binds by default
+    g = Graph(bind_namespaces='none')
+    g.bind('rdf', RDF)
+    g.bind('xsd', XSD)
+    if plan:
+        for prefix, namespace in plan.namespaces:
+            g.bind(prefix, Namespace(namespace))
+
+    writer = RDFSegitturWriter(stream, plan, resource_metadata, package_metadata,
+                               serializer(g, resource_metadata), location)
+    writer.write_header()
+    try:
+        yield writer
+        writer.write_footer()
+    finally:
+        writer.errors.log()
+
+
+# Python types of the values written as literals
+LITERAL_TYPES = frozenset([str, int, float, bool])
+
+# literals kept by RDFSegitturWriter._literal, emptied when it grows beyond
+LITERALS_CACHE_SIZE = 100000
+
+
+def _location_values(location_plan, location):
+    # (predicate, Literal) of each field of the organization location
+    return [(getattr(location_plan, field), Literal(value)) for field, value in location]
 
 
 class RDFSegitturWriter(object):
 
-    def __init__(self, stream, columns, ontology_dict, resource_metadata, package_metadata, graph):
+    def __init__(self, stream, plan, resource_metadata, package_metadata, serializer, location=()):
         self.stream = stream
-        self.columns = columns
-        self.ontology_dict = ontology_dict
+        self.plan = plan
         self.resource_metadata = resource_metadata
         self.package_metadata = package_metadata
-        self.graph = graph
-        self.namespaces_dict = {p: Namespace(n) for p,n in self.graph.namespaces()}
-
-    def _record_to_dict(self, record):
-        record_dict = {}
-        index = 0
-        for column in self.columns:
-            record_dict[column] =  record[index]
-            index += 1
-        return record_dict
-
-    def _add_entity_namespace(self, predicate):
-        prefix = predicate.split(':')[1].lower().strip()
-        namespace_uri = BASEURI + prefix + '#'
-        namespace = Namespace(namespace_uri)
-        self.graph.bind(prefix, namespace)
-        self.namespaces_dict[prefix] = namespace
-        # print(prefix,  namespace_uri)
-        return prefix
-
-    def _get_id(self):
-        id_predicate = None
-        prefix = None
-        ontology = None
-        id_prefix = None
-        for k, v in self.ontology_dict.items():
-            if v['info'].get('function') == "str_to_id":
-                id_predicate = k[1]
-                prefix = v['info'].get('prefix').lower().strip()
-                ontology = k[0]
-                id_prefix = self._add_entity_namespace(id_predicate)
-
-        return id_prefix, id_predicate, prefix, ontology
-
-    def _transform_value(self, value, function):
-        if not function:
-            if value:
-                return value.strip()
-            else:
-                return value
-        elif function == 'str_to_id':
-            norm_value = re.sub('[^A-Za-z0-9_\-]+', '', unidecode(value.strip().replace(' ', '_')))
-            return(norm_value.upper())
-        elif function == 'cast_to_int':
-            try:
-                transformed_value = int(value.strip())
-                return transformed_value
-            except ValueError as v:
-                log.warn('Could not convert value to int (retrying float): "' + str(value.strip()) + '" Exception: ' + str (v))
-                try:
-                    transformed_value = float(value.strip())
-                    return round(transformed_value)
-                except ValueError as v:
-                    log.warn('Could not convert value to int or float: "' + str(value.strip()) + '" Exception: ' + str(v))
-                    return None
-        elif function == 'stars_to_int':
-            try:
-                text_value = (value.upper().split(' ESTRELLA')[0].strip())
-                stars_count = ['UNA', 'DOS', 'TRES', 'CUATRO', 'CINCO']
-                stars_map_dict = {k: stars_count.index(k)+1 for k in stars_count}
-                return stars_map_dict[text_value]
-            except Exception as v:
-                try:
-                    text_value = value.strip().lower().replace('e', '')
-                    transformed_value = int(text_value)
-                    return transformed_value
-                except ValueError as v:
-                    log.warn('Could not convert stars to int: "' + str(value.strip()) + '" Exception: ' + str(v))
-                    return None
-        elif function == 'str_to_coordinate_1' or function == 'str_to_coordinate_2':
-            try:
-                values = [float(v.strip()) for v in value.split(',')]
-                if function == 'str_to_coordinate_1':
-                    return values[0]
-                else:
-                    return values[1]
-            except ValueError as v:
-                log.warn('Could not convert value to float: "' + str(value.strip()) + '" Exception: ' + str(v))
-                return None
-        elif function == 'match_hotel_speciality':
-            value_fix = ' '.join([t for t in value.strip().lower().split(' ') if t])
-            if value_fix in ['rural', 'casa rural']:
-                return self.namespaces_dict['turismo']['ruralHotel']
-            return None
-        else:
-            raise Exception("Not implemented: " + str(function))
-
-    def _get_tag(self, ontology, tag, record):
-        key = (ontology, tag)
-        if self.ontology_dict.get(key):
-            field = self.ontology_dict.get(key)['id']
-            function = self.ontology_dict.get(key)['info'].get('function')
-            value = self._transform_value(record[field], function)
-            if value is not None:
-                return value
-        return None
-
-    def _add_record_to_graph(self, record, count):
-
-        identifier = None
-        entity = None
+        self.serializer = serializer
+        self.triples = []
+        self.record_triples = {}
+        self.errors = ontology.TransformErrors()
+        self.stats = metrics.ExportStats()
+        # plan of the pages transformed in SQL, see pushdown.py
+        self.sql_plan = None
+        self.literals = {}
+        # (predicate, Literal) of the location of every record, they only
+        # depend on the organization
+        self.location_values = []
+        if plan is not None:
+            self.location_values = _location_values(plan.location, location)
+
+    def write_header(self):
+        self.stream.write(self.serializer.header())
+
+    def write_footer(self):
+        self.stream.write(self.serializer.footer())
+
+    def _add(self, triple):
+        # dict keeps insertion order and drops repeated parent triples
+        self.record_triples[triple] = None
+
+    def _end_record(self):
+        self.triples.extend(self.record_triples)
+        self.record_triples = {}
+
+    def _flush_triples(self):
+        start = time.perf_counter()
+        self.stream.write(self.serializer.serialize(self.triples))
+        self.stats.serialize_seconds.append(time.perf_counter() - start)
+        self.stats.triples += len(self.triples)
+        self.triples = []
+
+    def _add_record_to_graph(self, record_id, values):
+        plan = self.plan
 
         # identifier (MANDATORY)
-        entity_name, id_predicate, id_prefix, id_ontology = self._get_id()
-        if id_predicate:
-            id_field = self.ontology_dict.get((id_ontology, id_predicate))['id']
-            function = self.ontology_dict.get((id_ontology, id_predicate))['info'].get('function')
-            identifier = str(count + 1) + '_' + self._transform_value(record[id_field], function)
-
-            # generate hotel:6_CV_H00108_A a turismo:Hotel;
-            namespace_id = self.namespaces_dict[entity_name]
-            namespace_parent = self.namespaces_dict[id_prefix]
-            entity = URIRef(namespace_id[identifier])
-            self.graph.add((entity, RDF.type, namespace_parent[id_predicate.split(":")[1].strip()]))
-
-        else:
-            # fail
-            log.warn("No ontology id predicate defined")
-            return None
+        # generate hotel:CV_H00108_A a turismo:Hotel;
+        # derived only from the record content, so the URIs of a record stay
+        # the same between loads (rows with the same identifier are merged)
+        identifier = record_id
+        entity = plan.entity_namespace[identifier]
+        self._add((entity, RDF.type, plan.entity_class))
 
         # default add location
-        location_prefix = self._add_entity_namespace("turismo:Location")
-        location = URIRef(self.namespaces_dict[location_prefix][identifier])
-        self.graph.add((entity, self.namespaces_dict['turismo']['hasLocation'], location))
-        self.graph.add((location, RDF.type, self.namespaces_dict['turismo']['Location']))
-        self.graph.add((location, self.namespaces_dict['turismo']['country'], Literal("España")))
-        aut_community = None
-        org_ac_dict = {c: "Comunitat Valenciana" for c in ['gva', 'alcoi', 'torrent', 'sagunto', 'valencia', 'dipcas']}
-        organization = self.package_metadata['organization']['name']
-        if organization in org_ac_dict.keys():
-            aut_community = org_ac_dict[organization]
-        if aut_community:
-            self.graph.add((location, self.namespaces_dict['turismo']['autonomousCommunity'], Literal(aut_community)))
-        province_dict = {'alcoi': 'Alicante', 'torrent': 'Valencia', 'sagunto': 'Valencia',
-                         'valencia': 'Valencia', 'dipcas': 'Castellon'}
-        if organization in province_dict.keys():
-            province = province_dict[organization]
-            if province:
-                self.graph.add((location, self.namespaces_dict['turismo']['province'], Literal(province)))
-        city_dict = {'alcoi': 'Alcoi', 'torrent': 'Torrent', 'sagunto': 'Sagunto'}
-        if organization in city_dict.keys():
-            city = city_dict[organization]
-            if province:
-                self.graph.add((location, self.namespaces_dict['turismo']['city'], Literal(city)))
+        location_plan = plan.location
+        location = location_plan.namespace[identifier]
+        self._add((entity, location_plan.has_location, location))
+        self._add((location, RDF.type, location_plan.rdf_class))
+        for predicate, value in self.location_values:
+            self._add((location, predicate, value))
 
         # get other rfd predicates
-        for k, v in self.ontology_dict.items():
-            ontology, predicate = k
-            if ontology != id_ontology or predicate != id_predicate:
-                #TODO Make this work for arbitrary parent levels
-                if len(predicate.split(PREDICATOR_SEP)) == 3:
-                    predicate_list = predicate.split('/')
-                    verb = predicate_list[0].split(':')
-                    parent = predicate_list[1].split(':')
-                    parent_name = self._add_entity_namespace(predicate_list[1])
-                    parent_entity = URIRef(self.namespaces_dict[parent_name][identifier])
-                    child_predicate = predicate_list[2]
-                elif len(predicate.split(PREDICATOR_SEP)) == 1:
-                    parent = None
-                    parent_entity = entity
-                    child_predicate = predicate
+        literal = self._literal
+        for prop, rdf_value in zip(plan.properties, values):
+            if rdf_value is not None and rdf_value != "":
+                if prop.parent is not None:
+                    parent_entity = prop.parent.namespace[identifier]
+                    self._add((entity, prop.parent.verb, parent_entity))
+                    self._add((parent_entity, RDF.type, prop.parent.rdf_class))
                 else:
-                    log.warn("Possibly wrong predicate " + predicate)
-                    continue
-
-                child = child_predicate.split(':')
-
-                rdf_value = self._get_tag(ontology, predicate, record)
-                prefix = v['info']['prefix']
-
-                rdf_predicate = self.namespaces_dict[prefix][child[1].strip()]
-                if rdf_value is not None and rdf_value != "":
-                    if parent is not None:
-                        self.graph.add((entity, self.namespaces_dict[verb[0]][verb[1]], parent_entity))
-                        self.graph.add((parent_entity, RDF.type, self.namespaces_dict[parent[0]][parent[1]]))
+                    parent_entity = entity
 
-                    if type(rdf_value) in [str, int, float, bool]:
-                        self.graph.add((parent_entity, rdf_predicate, Literal(rdf_value)))
-                    else:
-                        self.graph.add((parent_entity, rdf_predicate, rdf_value))
+                if type(rdf_value) in LITERAL_TYPES:
+                    self._add((parent_entity, prop.predicate, literal(rdf_value)))
+                else:
+                    self._add((parent_entity, prop.predicate, rdf_value))
         return
 
+    def _literal(self, value):
+        # values repeat a lot (stars, capacities, types...), each Literal is
+        # created once; the type is part of the key as 1 == 1.0 == True
+        key = (type(value), value)
+        literal = self.literals.get(key)
+        if literal is None:
+            if len(self.literals) >= LITERALS_CACHE_SIZE:
+                self.literals.clear()
+            literal = self.literals[key] = Literal(value)
+        return literal
+
     def write_records(self, records):
-        # TODO Write record-by-record to RDF (write header an footer outside of this function)
-        count = 0
-        for r in records:
+        self.stats.rows += len(records)
+        plan = self.sql_plan if isinstance(records, pushdown.SQLRecords) else self.plan
+        if plan is None:
+            return
+        start = time.perf_counter()
+        # values are converted column by column for the whole page
+        identifiers, columns = ontology.transform_page(plan, records, self.errors)
+        rows = zip(*columns) if columns else repeat(())
+        for index, (record_id, values) in enumerate(zip(identifiers, rows)):
+            if record_id is None:
+                continue
             try:
-                record = self._record_to_dict(r)
-                self._add_record_to_graph(record, count)
-                count += 1
+                self._add_record_to_graph(record_id, values)
+                self._end_record()
 
             except Exception as e:
-                log.warn("Error converting #" + str(count)+ " record with id " + str(record.get('_id', '??'))
-                         + ", Exception: " + str(e))
-                
-        self.stream.write(self.graph.serialize(format='ttl'))
+                log.warn("Error converting #" + str(index) + " record, Exception: " + str(e))
+                self.record_triples = {}
+
+        self.stats.convert_seconds.append(time.perf_counter() - start)
+        self._flush_triples()
+
+
+# export formats: writer, serializer, file extension and content type
+RDF_FORMATS = {}
+
+
+def register_rdf_format(file_format, writer, serializer, extension, content_type, internal=False):
+    """
+    Make `file_format` available to the export, along with its gzip
+    compressed `<file_format>_gz` variant. `internal` formats are only
+    produced by the extension itself, never served.
+    """
+    RDF_FORMATS[file_format] = {
+        'writer': writer,
+        'serializer': serializer,
+        'extension': extension,
+        'content_type': content_type,
+        'internal': internal,
+    }
+    RDF_FORMATS[file_format + '_gz'] = dict(
+        RDF_FORMATS[file_format],
+        extension=extension + '.gz',
+        content_type='application/gzip',
+        compress=True,
+    )
+
+
+register_rdf_format('rdf_segittur', rdf_segittur_writer, serializers.TurtleSerializer,
+                    'ttl', 'application/x-turtle; charset=utf-8')
+register_rdf_format('rdf_segittur_grouped', rdf_segittur_writer, serializers.GroupedTurtleSerializer,
+                    'ttl', 'application/x-turtle; charset=utf-8')
+register_rdf_format('rdf_segittur_nt', rdf_segittur_writer, serializers.NTriplesSerializer,
+                    'nt', 'application/n-triples; charset=utf-8')
+register_rdf_format('rdf_segittur_nq', rdf_segittur_writer, serializers.NQuadsSerializer,
+                    'nq', 'application/n-quads; charset=utf-8')
+register_rdf_format('rdf_segittur_jsonld', rdf_segittur_writer, serializers.JSONLDSerializer,
+                    'jsonld', 'application/ld+json; charset=utf-8')
+register_rdf_format('rdf_segittur_snapshot', rdf_segittur_writer, serializers.SnapshotSerializer,
+                    'snapshot', 'text/plain; charset=utf-8', internal=True)
@@ -0,0 +1,141 @@
+import threading
+import time
+
+from ckanext.wakeua import helpers
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# upper bounds (seconds) of the page timing histogram buckets
+PAGE_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name: (type, help) of the metrics exposed by render()
+METRICS = {
+    'wakeua_exports_total': ('counter', 'RDF exports by format and status (completed or aborted).'),
+    'wakeua_export_rows_total': ('counter', 'Datastore rows converted to RDF.'),
+    'wakeua_export_triples_total': ('counter', 'RDF triples written.'),
+    'wakeua_export_bytes_total': ('counter', 'Bytes of RDF sent or stored.'),
+    'wakeua_export_seconds_total': ('counter', 'Wall clock time of the RDF exports.'),
+    'wakeua_export_transform_failures_total': (
+        'counter', 'Values the ontology transforms could not convert, by function and column.'),
+    'wakeua_export_page_seconds': (
+        'histogram', 'Time spent on each datastore page, by stage (fetch, convert or serialize).'),
+    'wakeua_cache_requests_total': ('counter', 'Lookups of the multilingual value caches, by cache and result.'),
+}
+
+_lock = threading.Lock()
+# {metric name: {labels tuple: value}}, histograms hold [bucket counts, sum, count]
+_values = {}
+
+
+class ExportStats(object):
+    """
+    Timings and counts of one RDF export. Conversion processes keep their
+    own and send them back with each page, see `merge`.
+    """
+
+    def __init__(self, resource_id=None, file_format=None):
+        self.resource_id = resource_id
+        self.file_format = file_format
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.triples = 0
+        self.bytes = 0
+        # seconds spent on each page, per stage
+        self.fetch_seconds = []
+        self.convert_seconds = []
+        self.serialize_seconds = []
+        self.errors = None
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.triples += other.triples
+        self.fetch_seconds.extend(other.fetch_seconds)
+        self.convert_seconds.extend(other.convert_seconds)
+        self.serialize_seconds.extend(other.serialize_seconds)
+
+    def summary(self, status):
+        elapsed = time.perf_counter() - self.started
+        failures = sum(self.errors.counts.values()) if self.errors else 0
+        return (
+            'RDF export of resource {0} as {1} {2}: {3} pages, {4} rows, {5} triples, {6} bytes in {7:.2f}s '
+            '({8:.0f} rows/s; fetch {9:.2f}s, convert {10:.2f}s, serialize {11:.2f}s), '
+            '{12} transform failures'.format(
+                self.resource_id, self.file_format, status, len(self.fetch_seconds), self.rows, self.triples,
+                self.bytes, elapsed, self.rows / elapsed if elapsed else 0, sum(self.fetch_seconds),
+                sum(self.convert_seconds), sum(self.serialize_seconds), failures))
+
+
+def record_export(stats, completed):
+    """
+    Add the stats of a finished (or aborted) export to the process metrics
+    and log its summary.
+    """
+    status = 'completed' if completed else 'aborted'
+    labels = (('format', stats.file_format),)
+    with _lock:
+        _inc('wakeua_exports_total', labels + (('status', status),))
+        _inc('wakeua_export_rows_total', labels, stats.rows)
+        _inc('wakeua_export_triples_total', labels, stats.triples)
+        _inc('wakeua_export_bytes_total', labels, stats.bytes)
+        _inc('wakeua_export_seconds_total', labels, time.perf_counter() - stats.started)
+        for stage, seconds in [('fetch', stats.fetch_seconds), ('convert', stats.convert_seconds),
+                               ('serialize', stats.serialize_seconds)]:
+            for value in seconds:
+                _observe('wakeua_export_page_seconds', labels + (('stage', stage),), value)
+        if stats.errors:
+            for (function, column), count in stats.errors.counts.items():
+                _inc('wakeua_export_transform_failures_total',
+                     (('function', function or ''), ('column', column)), count)
+    log.info(stats.summary(status))
+
+
+def _inc(name, labels, value=1):
+    metric = _values.setdefault(name, {})
+    metric[labels] = metric.get(labels, 0) + value
+
+
+def _observe(name, labels, value):
+    metric = _values.setdefault(name, {})
+    histogram = metric.setdefault(labels, [[0] * len(PAGE_SECONDS_BUCKETS), 0.0, 0])
+    for i, bound in enumerate(PAGE_SECONDS_BUCKETS):
+        if value <= bound:
+            histogram[0][i] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+
+def render():
+    """
+    Return the metrics of this process in the Prometheus text format.
+    """
+    lines = []
+    cache_requests = {}
+    for cache, stats in helpers.wakeua_cache_stats().items():
+        for result in ('hits', 'misses'):
+            cache_requests[(('cache', cache), ('result', result))] = stats[result]
+    with _lock:
+        values = dict(_values, wakeua_cache_requests_total=cache_requests)
+        for name, (metric_type, description) in METRICS.items():
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for labels, value in sorted(values.get(name, {}).items()):
+                if metric_type == 'histogram':
+                    buckets, total, count = value
+                    for bound, bucket in zip(PAGE_SECONDS_BUCKETS, buckets):
+                        lines.append('{0}_bucket{1} {2}'.format(
+                            name, _format_labels(labels + (('le', bound),)), bucket))
+                    lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), total))
+                    lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), count))
+                else:
+                    lines.append('{0}{1} {2}'.format(name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,499 @@
+import hashlib
+import json
+import re
+import threading
+from collections import namedtuple, OrderedDict
+
+from rdflib.namespace import Namespace
+from unidecode import unidecode
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+PREDICATOR_SEP = '/'
+
+# Base URI for the generated entities (hotel:..., location:..., ...)
+BASEURI = "https://tdata.dlsi.ua.es/recurso/turismo/"
+
+# Compiled mapping of a resource to RDF, built once per export
+OntologyPlan = namedtuple('OntologyPlan', [
+    'namespaces',  # ((prefix, namespace uri), ...) to bind in the output
+    'id_index',  # position of the identifier column in the records
+    'id_column',  # identifier column name, for logging
+    'id_transform',  # column transform of the identifier (str_to_id)
+    'entity_namespace',  # Namespace of the generated entities
+    'entity_class',  # URIRef of the rdf:type of the entities
+    'location',  # LocationPlan
+    'properties',  # tuple of PropertyPlan
+])
+
+PropertyPlan = namedtuple('PropertyPlan', [
+    'index',  # position of the column in the records
+    'column',  # column name, for logging
+    'function',  # name of the transform function, for logging
+    'prepare',  # column transform stage shared within a column, or None
+    'transform',  # column transform turning raw values into RDF values
+    'predicate',  # URIRef of the predicate
+    'parent',  # ParentPlan or None if the predicate applies to the entity
+])
+
+LocationPlan = namedtuple('LocationPlan', [
+    'namespace',  # Namespace of the generated locations
+    'rdf_class',
+    'has_location',
+    'country',
+    'autonomous_community',
+    'province',
+    'city',
+])
+
+ParentPlan = namedtuple('ParentPlan', [
+    'namespace',  # Namespace of the intermediate entity
+    'verb',  # URIRef linking the entity to the intermediate entity
+    'rdf_class',  # URIRef of the rdf:type of the intermediate entity
+])
+
+
+# compiled plans kept in memory, see get_ontology_plan
+PLAN_CACHE_SIZE = 256
+
+# ontology functions accepted by get_transform
+FUNCTIONS = frozenset([
+    'str_to_id', 'cast_to_int', 'stars_to_int', 'str_to_coordinate_1', 'str_to_coordinate_2',
+    'match_hotel_speciality',
+])
+
+_PREDICATE = re.compile(r'^\s*[A-Za-z_][\w\-]*\s*:\s*[A-Za-z_][\w\-.]*\s*$')
+
+
+def _parse_ontology_info(value):
+    # the ontology info is a JSON list of mappings, often with single quotes
+    return json.loads(value.replace("'", '"'))
+
+
+def parse_ontology_dict(datastore_info):
+    """
+    Build a {(ontology, predicate): {'id': field name, 'info': info}} dict
+    from the `ontology` info of the data dictionary fields.
+    """
+    ontology_dict = {}
+    for field in datastore_info:
+        if len(field.get('info', {}).get('ontology', '')) > 0:
+            try:
+                ontology_infos = _parse_ontology_info(field.get('info', {}).get('ontology', ''))
+                field_name = field['id']
+                for info in ontology_infos:
+                    ontology = info.get('ontology')
+                    predicate = info.get('predicate')
+                    prefix = info.get('prefix')
+                    if ontology and prefix and predicate:
+                        ontology_dict[(ontology, predicate)] = {'id': field_name, 'info': info}
+
+            except Exception as e:
+                log.warn("WARN: could not parse JSON from ontology info on field data: " + str(field) + "\n" + str(e))
+    return ontology_dict
+
+
+def mapped_columns(datastore_info):
+    """
+    Return the (identifier column, mapped columns) of the ontology mapping
+    of the data dictionary, the columns in dictionary order. The identifier
+    column is None if there is no `str_to_id` mapping.
+    """
+    ontology_dict = parse_ontology_dict(datastore_info)
+    id_column = None
+    for item in ontology_dict.values():
+        if item['info'].get('function') == 'str_to_id':
+            id_column = item['id']
+    mapped = set(item['id'] for item in ontology_dict.values())
+    return id_column, [f['id'] for f in datastore_info if f['id'] in mapped]
+
+
+def export_columns(datastore_info):
+    """
+    Return the columns of the records of the whole-resource exports: "_id"
+    and the mapped columns, or every column if the mapping has no
+    identifier. Their plans are compiled (and cached) for these columns.
+    """
+    id_column, mapped = mapped_columns(datastore_info)
+    if id_column is None:
+        mapped = [f['id'] for f in datastore_info]
+    return ['_id'] + mapped
+
+
+def validate_ontology_dictionary(fields):
+    """
+    Check the ontology mappings of the data dictionary `fields` (as sent
+    to datastore_create). Returns a {field id: [error messages]} dict,
+    empty if the mapping is valid or there is none.
+    """
+    errors = {}
+    mappings = []
+    prefixes = set()
+    for field in fields:
+        value = (field.get('info') or {}).get('ontology') or ''
+        if not value.strip():
+            continue
+        field_errors = errors.setdefault(field['id'], [])
+        try:
+            infos = _parse_ontology_info(value)
+        except ValueError as e:
+            field_errors.append('Ontology is not valid JSON: ' + str(e))
+            continue
+        if not isinstance(infos, list) or not all(isinstance(info, dict) for info in infos):
+            field_errors.append('Ontology must be a list of {"ontology", "prefix", "predicate"} objects')
+            continue
+        for info in infos:
+            missing = [k for k in ('ontology', 'prefix', 'predicate') if not info.get(k)]
+            if missing:
+                field_errors.append('Ontology mapping without ' + ', '.join(missing))
+                continue
+            prefixes.add(info['prefix'])
+            mappings.append((field['id'], info))
+
+    id_fields = [field_id for field_id, info in mappings if info.get('function') == 'str_to_id']
+    for field_id, info in mappings:
+        field_errors = errors.setdefault(field_id, [])
+        function = info.get('function')
+        if function and function not in FUNCTIONS:
+            field_errors.append('Unknown ontology function "{0}"'.format(function))
+        parts = info['predicate'].split(PREDICATOR_SEP)
+        if len(parts) not in (1, 3) or not all(_PREDICATE.match(part) for part in parts):
+            field_errors.append('Predicate "{0}" must be "prefix:name" or '
+                                '"prefix:verb/prefix:Class/prefix:name"'.format(info['predicate']))
+            continue
+        for part in parts:
+            prefix = part.split(':')[0].strip()
+            if prefix not in prefixes:
+                field_errors.append('Prefix "{0}" of predicate "{1}" is not defined'.format(
+                    prefix, info['predicate']))
+    if mappings:
+        first = mappings[0][0]
+        if len(id_fields) != 1:
+            errors.setdefault(id_fields[1] if id_fields else first, []).append(
+                'The ontology mapping needs exactly one "str_to_id" identifier field')
+        if 'turismo' not in prefixes:
+            errors.setdefault(first, []).append('The ontology mapping needs the "turismo" prefix')
+    return {field_id: messages for field_id, messages in errors.items() if messages}
+
+
+def dictionary_hash(datastore_info):
+    # identifies the ontology mapping of a data dictionary
+    return hashlib.sha1(json.dumps(
+        [[f.get('id'), (f.get('info') or {}).get('ontology')] for f in datastore_info]
+    ).encode('utf-8')).hexdigest()
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def get_ontology_plan(resource_id, datastore_info, columns):
+    """
+    Return the OntologyPlan of the data dictionary for records with the
+    given `columns`, compiling it only if it isn't cached for this resource
+    and version of the dictionary.
+    """
+    key = (resource_id, dictionary_hash(datastore_info), tuple(columns))
+    with _plans_lock:
+        if key in _plans:
+            _plans.move_to_end(key)
+            return _plans[key]
+    plan = compile_ontology_plan(parse_ontology_dict(datastore_info), list(columns))
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+def entity_namespace(name):
+    # "turismo:Hotel" -> ('hotel', Namespace(BASEURI + 'hotel#'))
+    prefix = name.split(':')[1].lower().strip()
+    return prefix, Namespace(BASEURI + prefix + '#')
+
+
+class TransformErrors(object):
+    """
+    Values the transforms could not convert, counted per (function, column)
+    and logged once per export instead of once per cell.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.samples = {}
+
+    def add(self, function, column, failed):
+        if failed:
+            key = (function, column)
+            self.counts[key] = self.counts.get(key, 0) + len(failed)
+            self.samples.setdefault(key, failed[0])
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+            self.samples.setdefault(key, other.samples[key])
+
+    def log(self):
+        for (function, column), count in self.counts.items():
+            log.warn('Could not apply "{0}" to {1} value(s) of column "{2}", e.g. "{3}"'.format(
+                function, count, column, self.samples[(function, column)]))
+
+
+# Column transforms: take all the values of a column in a page and a list
+# where values that can't be converted are appended, return the converted
+# values in the same order. Empty values become None without failing.
+
+_ID_INVALID_CHARS = re.compile(r'[^A-Za-z0-9_\-]+')
+
+STARS_MAP = {'UNA': 1, 'DOS': 2, 'TRES': 3, 'CUATRO': 4, 'CINCO': 5}
+
+RURAL_SPECIALITIES = frozenset(['rural', 'casa rural'])
+
+
+def _strip(values, failed):
+    return [v.strip() if isinstance(v, str) else v for v in values]
+
+
+def str_to_id(values, failed):
+    sub = _ID_INVALID_CHARS.sub
+    result = []
+    for value in values:
+        record_id = None
+        if value is not None:
+            record_id = sub('', unidecode(str(value).strip().replace(' ', '_'))).upper()
+        if not record_id:
+            # no identifier, the record is skipped
+            failed.append(value)
+            record_id = None
+        result.append(record_id)
+    return result
+
+
+def _cast_to_int(value, failed):
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return round(value)
+    # numeric and array columns too
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return round(float(value))
+        except ValueError:
+            failed.append(value)
+            return None
+
+
+def cast_to_int(values, failed):
+    try:
+        # fast path for clean text columns
+        return [int(v.strip()) for v in values]
+    except (ValueError, TypeError, AttributeError):
+        return [_cast_to_int(v, failed) for v in values]
+
+
+def stars_to_int(values, failed):
+    result = []
+    for value in values:
+        stars = None
+        if value:
+            # the column may not be text (e.g. int or array)
+            text = str(value)
+            stars = STARS_MAP.get(text.upper().split(' ESTRELLA')[0].strip())
+            if stars is None:
+                try:
+                    stars = int(text.strip().lower().replace('e', ''))
+                except ValueError:
+                    failed.append(value)
+        result.append(stars)
+    return result
+
+
+def split_coordinates(values, failed):
+    # "lat, long" -> [lat, long], shared by both coordinate transforms
+    result = []
+    for value in values:
+        coordinates = None
+        if value:
+            try:
+                coordinates = [float(v) for v in value.split(',')]
+            except (ValueError, AttributeError):
+                failed.append(value)
+        result.append(coordinates)
+    return result
+
+
+def _str_to_coordinate(position):
+    def transform(coordinates, failed):
+        return [c[position] if c and len(c) > position else None for c in coordinates]
+    return transform
+
+
+def _match_hotel_speciality(namespaces):
+    rural_hotel = namespaces['turismo']['ruralHotel']
+
+    def transform(values, failed):
+        return [rural_hotel if value and ' '.join(str(value).lower().split()) in RURAL_SPECIALITIES else None
+                for value in values]
+    return transform
+
+
+def get_transform(function, namespaces):
+    """
+    Return a (prepare, transform) pair of column transforms implementing the
+    ontology `function`. `prepare` is None or a first stage shared by all the
+    properties of the same column using it. `namespaces` is a {prefix:
+    Namespace} dict of the mapping.
+    """
+    if not function:
+        return None, _strip
+    elif function == 'str_to_id':
+        return None, str_to_id
+    elif function == 'cast_to_int':
+        return None, cast_to_int
+    elif function == 'stars_to_int':
+        return None, stars_to_int
+    elif function == 'str_to_coordinate_1':
+        return split_coordinates, _str_to_coordinate(0)
+    elif function == 'str_to_coordinate_2':
+        return split_coordinates, _str_to_coordinate(1)
+    elif function == 'match_hotel_speciality':
+        return None, _match_hotel_speciality(namespaces)
+    else:
+        raise ValueError("Not implemented: " + str(function))
+
+
+def transform_page(plan, records, errors):
+    """
+    Apply the transforms of `plan` column by column to a page of 'lists'
+    records. Returns (identifiers, columns) where `columns` has one list of
+    converted values per plan property.
+    """
+    id_failed = []
+    identifiers = plan.id_transform([r[plan.id_index] for r in records], id_failed)
+    errors.add('str_to_id', plan.id_column, id_failed)
+
+    raw = {}
+    prepared = {}
+    columns = []
+    for prop in plan.properties:
+        if prop.index not in raw:
+            raw[prop.index] = [r[prop.index] for r in records]
+        values = raw[prop.index]
+        failed = []
+        if prop.prepare is not None:
+            key = (prop.index, prop.prepare)
+            if key not in prepared:
+                prepared[key] = prop.prepare(values, failed)
+            values = prepared[key]
+        columns.append(prop.transform(values, failed))
+        errors.add(prop.function, prop.column, failed)
+    return identifiers, columns
+
+
+def _resolve(name, namespaces):
+    # "turismo:hasGeo" -> URIRef in the namespace bound to "turismo"
+    prefix, local_name = name.split(':')
+    return namespaces[prefix.strip()][local_name.strip()]
+
+
+def compile_ontology_plan(ontology_dict, columns):
+    """
+    Compile the ontology mapping of a resource into an OntologyPlan for the
+    records with the given `columns`. Returns None if the mapping has no
+    identifier (`str_to_id`) predicate.
+    """
+    namespaces = {}
+    for key, item in ontology_dict.items():
+        prefix = item['info'].get('prefix')
+        namespaces[prefix] = Namespace(item['info']['ontology'])
+    bindings = dict(namespaces)
+
+    # identifier (MANDATORY)
+    id_key = None
+    for k, v in ontology_dict.items():
+        if v['info'].get('function') == "str_to_id":
+            id_key = k
+    if id_key is None or ontology_dict[id_key]['id'] not in columns:
+        log.warn("No ontology id predicate defined")
+        return None
+
+    id_ontology, id_predicate = id_key
+    id_info = ontology_dict[id_key]['info']
+    entity_prefix, entity_ns = entity_namespace(id_predicate)
+    bindings[entity_prefix] = entity_ns
+    if 'turismo' not in namespaces:
+        log.warn("No turismo ontology prefix defined")
+        return None
+    turismo = namespaces['turismo']
+    location_prefix, location_ns = entity_namespace("turismo:Location")
+    bindings[location_prefix] = location_ns
+    location = LocationPlan(
+        namespace=location_ns,
+        rdf_class=turismo['Location'],
+        has_location=turismo['hasLocation'],
+        country=turismo['country'],
+        autonomous_community=turismo['autonomousCommunity'],
+        province=turismo['province'],
+        city=turismo['city'],
+    )
+
+    properties = []
+    for k, v in ontology_dict.items():
+        if k == id_key:
+            continue
+        ontology, predicate = k
+        column = v['id']
+        function = v['info'].get('function')
+        if column not in columns:
+            log.warn("Ontology column not in the exported fields: " + column)
+            continue
+        try:
+            predicate_list = predicate.split(PREDICATOR_SEP)
+            #TODO Make this work for arbitrary parent levels
+            if len(predicate_list) == 3:
+                parent_prefix, parent_ns = entity_namespace(predicate_list[1])
+                bindings[parent_prefix] = parent_ns
+                parent = ParentPlan(
+                    namespace=parent_ns,
+                    verb=_resolve(predicate_list[0], namespaces),
+                    rdf_class=_resolve(predicate_list[1], namespaces),
+                )
+                child_predicate = predicate_list[2]
+            elif len(predicate_list) == 1:
+                parent = None
+                child_predicate = predicate
+            else:
+                log.warn("Possibly wrong predicate " + predicate)
+                continue
+
+            child = child_predicate.split(':')
+            prepare, transform = get_transform(function, namespaces)
+            properties.append(PropertyPlan(
+                index=columns.index(column),
+                column=column,
+                function=function,
+                prepare=prepare,
+                transform=transform,
+                predicate=namespaces[v['info']['prefix']][child[1].strip()],
+                parent=parent,
+            ))
+        except (ValueError, KeyError, IndexError) as e:
+            log.warn("Could not compile ontology predicate " + predicate + ": " + str(e))
+
+    return OntologyPlan(
+        namespaces=tuple((prefix, str(ns)) for prefix, ns in bindings.items()),
+        id_index=columns.index(ontology_dict[id_key]['id']),
+        id_column=ontology_dict[id_key]['id'],
+        id_transform=str_to_id,
+        entity_namespace=entity_ns,
+        entity_class=namespaces[id_info['prefix']][id_predicate.split(":")[1].strip()],
+        location=location,
+        properties=tuple(properties),
+    )
@@ -1,21 +1,31 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckan.common import config, _
+from ckan.common import _
 import os
 import json
 from ckan.lib.webassets_tools import add_public_path
 from ckan.lib.plugins import DefaultTranslation
 import ckanext.wakeua.blueprints as blueprints
+from ckanext.wakeua import cli
 from ckanext.wakeua import validators as v
 from ckanext.wakeua import helpers as wh
 from ckanext.wakeua import action as wa
+from ckanext.wakeua import auth as wauth
+from ckanext.wakeua import jobs
+from ckanext.wakeua import locations
+
+
+# CKAN default query fields (ckan.lib.search.query.QUERY_FIELDS)
+DEFAULT_QUERY_FIELDS = "name^4 title^4 tags^2 groups^2 text"
 
 
 class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.ITranslation, inherit=True)
     plugins.implements(plugins.IActions, inherit=True)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IClick)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IValidators)
     plugins.implements(plugins.IPackageController, inherit=True)
@@ -23,8 +33,6 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IGroupController, inherit=True)
     plugins.implements(plugins.IFacets, inherit=True)
 
-    LANGS = config.get('ckan.locale_order') or ["es"]
-
     # IConfigurer
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
@@ -36,9 +44,30 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
         )
         add_public_path(asset_path, '/')
 
+        # organization locations added to the RDF exports
+        locations.load_table()
+
     # IActions
     def get_actions(self):
-        return {'wakeua_list_datastore_resources': wa.list_datastore_resources}
+        return {
+            'wakeua_list_datastore_resources': wa.list_datastore_resources,
+            'wakeua_export_rdf': wa.export_rdf,
+            'wakeua_export_rdf_status': wa.export_rdf_status,
+            'datastore_create': wa.datastore_create,
+            'datastore_delete': wa.datastore_delete,
+            'datastore_upsert': wa.datastore_upsert,
+            'tag_create': wa.tag_create,
+            'tag_delete': wa.tag_delete,
+            'vocabulary_create': wa.vocabulary_create,
+            'vocabulary_update': wa.vocabulary_update,
+            'vocabulary_delete': wa.vocabulary_delete,
+        }
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        return {
+            'wakeua_export_rdf': wauth.export_rdf,
+        }
 
     # IPackageController
     # IOrganizationController IGroupController
@@ -59,29 +88,61 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
 
         return pkg_dict
 
+    # IOrganizationController IGroupController
+    def create(self, entity):
+        self._clear_locations(entity)
+
+    def edit(self, entity):
+        self._clear_locations(entity)
+
+    def delete(self, entity):
+        self._clear_locations(entity)
+
+    def _clear_locations(self, entity):
+        # the location fields of organizations change their RDF exports, the
+        # hooks are also called for datasets and groups
+        if getattr(entity, 'is_organization', False):
+            locations.clear_locations_cache()
+
     def after_create(self, context, data_dict):
-        for resource in data_dict.get("resources", []):
-            if resource["format"].upper()=="CSV":
-                plugins.toolkit.get_action('xloader_submit')(context, {
-                    'resource_id': resource["id"]
-                })
+        self._enqueue_resources_load(data_dict)
 
     def after_update(self, context, data_dict):
-        for resource in data_dict.get("resources", []):
-            if resource["format"].upper()=="CSV":
-                plugins.toolkit.get_action('xloader_submit')(context, {
-                    'resource_id': resource["id"]
-                })
+        self._enqueue_resources_load(data_dict)
+
+    def _enqueue_resources_load(self, data_dict):
+        # one job per package, it only submits to xloader the CSV resources
+        # that changed and refreshes the RDF exports of the others
+        resources = [{
+            'id': resource["id"],
+            'fingerprint': jobs.resource_fingerprint(resource),
+            'datastore_active': bool(resource.get("datastore_active")),
+        } for resource in data_dict.get("resources", []) if resource.get("format", "").upper()=="CSV"]
+        if resources:
+            toolkit.enqueue_job(jobs.load_package_resources, [resources],
+                                title='wakeua load resources ' + data_dict.get("name", ""))
 
     def before_index(self, pkg_dict):
+        langs = wh.wakeua_locale_order()
         # fix utf-8 chars issues
         for field in ["title", "notes"]:
             if pkg_dict.get(field):
                 value = pkg_dict.get(field)
                 try:
-                    pkg_dict[field] = json.dumps(json.loads(pkg_dict[field]), ensure_ascii=False)
+                    translations = json.loads(pkg_dict[field])
+                    pkg_dict[field] = json.dumps(translations, ensure_ascii=False)
                 except Exception as e:
                     pkg_dict[field] = value
+                    continue
+                # per language fields (title_es, notes_ca...), see solr/conf/schema.xml
+                if isinstance(translations, dict):
+                    for lang in langs:
+                        if translations.get(lang):
+                            pkg_dict[field + '_' + lang] = translations[lang]
+        # language aware sorting, falls back to the default language
+        for lang in langs:
+            pkg_dict['title_sort_' + lang] = pkg_dict.get('title_' + lang) or \
+                pkg_dict.get('title_' + langs[0]) or pkg_dict.get('title') or pkg_dict.get('name')
         # fix fr resources
         for field in ["res_name", "res_description"]:
             if pkg_dict.get(field):
@@ -99,6 +160,26 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
             pkg_dict["schemaorg_tags"] = [tag.strip() for tag in extras_tag_string_schemaorg.split(',')]
         return pkg_dict
 
+    def before_search(self, search_params):
+        try:
+            lang = toolkit.request.environ['CKAN_LANG']
+        except (TypeError, RuntimeError, KeyError, AttributeError):
+            # outside of a web request
+            return search_params
+        if lang not in wh.wakeua_locale_order():
+            return search_params
+
+        # sort by the title in the current language
+        sort = search_params.get('sort')
+        if sort and 'title_string' in sort:
+            search_params['sort'] = sort.replace('title_string', 'title_sort_' + lang)
+
+        # boost matches in the current language
+        if not search_params.get('qf') and not search_params.get('defType'):
+            search_params['qf'] = DEFAULT_QUERY_FIELDS + \
+                ' title_{0}^4 notes_{0}^2'.format(lang)
+        return search_params
+
     # IFacets
     def dataset_facets(self, facets_dict, package_type):
         facets_dict['schemaorg_tags'] = _('Keywords')
@@ -119,6 +200,10 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
     def get_blueprint(self):
         return blueprints.get_blueprints(self.name, self.__module__)
 
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
+
     # IValidators
     def get_validators(self):
         return {
@@ -146,6 +231,7 @@ class WakeuaPlugin(plugins.SingletonPlugin, DefaultTranslation):
             'get_facet_items_dict': wh.wakeua_get_facet_items_dict,
             'wakeua_extract_tags': wh.wakeua_extract_tags,
             'wakeua_get_vocabulary_tags': wh.wakeua_get_vocabulary_tags,
+            'wakeua_get_vocabulary_lang_tags': wh.wakeua_get_vocabulary_lang_tags,
             'wakeua_show_dataset_vocabulary_tags': wh.wakeua_show_dataset_vocabulary_tags,
             'wakeua_truncate_facet_label': wh.wakeua_truncate_facet_label,
         }
@@ -0,0 +1,220 @@
+"""
+Ontology transforms computed by PostgreSQL in the keyset export query.
+
+Each transform is compiled into a SQL expression returning the converted
+value as JSON, or the raw value wrapped in an array (`[value]`) when it
+can't be converted exactly like the Python transform would (e.g. non
+ASCII text, decimals rounded to int). Those go through the Python
+transform, which also counts the values that fail.
+"""
+from collections import namedtuple
+
+import sqlalchemy as sa
+
+from ckan.plugins.toolkit import config, asbool
+from ckanext.datastore.backend import postgres as datastore_postgres
+from ckanext.wakeua import ontology
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# compute the ontology transforms in the datastore query (optional)
+SQL_TRANSFORMS = 'ckanext.wakeua.export.sql_transforms'
+
+# characters removed by str.strip() in ASCII text
+_WS = u"E' \\t\\n\\r\\f\\x0B\\x1C\\x1D\\x1E\\x1F'"
+
+_ASCII = u"'^[\\x01-\\x7F]*$'"
+
+# Latin-1 letters, unaccent gives them the same ASCII as unidecode
+_LATIN1_LETTERS = u"'^[\\x01-\\x7F\\u00C0-\\u00D6\\u00D8-\\u00F6\\u00F8-\\u00FF]*$'"
+
+_NUMBER = u'\\s*[+-]?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][+-]?[0-9]+)?\\s*'
+
+SQLPlan = namedtuple('SQLPlan', [
+    'expressions',  # SQL expressions of the records columns, "_id" first
+    'plan',  # OntologyPlan of the records returned by `expressions`
+])
+
+
+class SQLRecords(list):
+    """
+    A page of records returned by the `expressions` of a SQLPlan, instead of
+    the datastore columns.
+    """
+
+
+def enabled():
+    return asbool(config.get(SQL_TRANSFORMS, False))
+
+
+_unaccent = []
+
+
+def has_unaccent():
+    # whether the unaccent extension is installed, checked once per process
+    if not _unaccent:
+        with datastore_postgres.get_read_engine().connect() as conn:
+            _unaccent.append(conn.execute(sa.text(
+                u"SELECT count(*) FROM pg_extension WHERE extname = 'unaccent'")).scalar() > 0)
+    return _unaccent[0]
+
+
+def _str_to_id(column, unaccent):
+    text = u"replace(btrim({0}, {1}), ' ', '_')".format(column, _WS)
+    guard = _ASCII
+    if unaccent:
+        text = u'unaccent({0})'.format(text)
+        guard = _LATIN1_LETTERS
+    return (
+        u"coalesce(CASE WHEN {0} ~ {1} THEN to_json(nullif("
+        u"upper(regexp_replace({2}, '[^A-Za-z0-9_-]+', '', 'g')), '')) END, json_build_array({0}))"
+    ).format(column, guard, text)
+
+
+def _cast_to_int(column):
+    return (
+        u"CASE WHEN {0} IS NULL OR btrim({0}, {1}) = '' THEN NULL "
+        u"WHEN btrim({0}, {1}) ~ '^[+-]?[0-9]{{1,18}}$' THEN to_json(btrim({0}, {1})::bigint) "
+        u"ELSE json_build_array({0}) END"
+    ).format(column, _WS)
+
+
+def _stars_to_int(column):
+    stars = u' '.join(u"WHEN '{0}' THEN to_json({1})".format(name, stars)
+                      for name, stars in sorted(ontology.STARS_MAP.items()))
+    digits = u"replace(lower(btrim({0}, {1})), 'e', '')".format(column, _WS)
+    return (
+        u"CASE WHEN {0} IS NULL OR {0} = '' THEN NULL "
+        u"WHEN {0} ~ {1} THEN coalesce("
+        u"CASE btrim(split_part(upper({0}), ' ESTRELLA', 1), {2}) {3} END, "
+        u"CASE WHEN {4} ~ '^\\s*[+-]?[0-9]{{1,9}}\\s*$' THEN to_json(btrim({4}, {2})::int) END, "
+        u"json_build_array({0})) "
+        u"ELSE json_build_array({0}) END"
+    ).format(column, _ASCII, _WS, stars, digits)
+
+
+def _str_to_coordinate(column, position):
+    # the number is parsed by float() like the Python transform does (numeric
+    # would turn "-0" into 0)
+    return (
+        u"CASE WHEN {0} IS NULL OR {0} = '' THEN NULL "
+        u"WHEN {0} ~ '^{1}(,{1})*$' THEN to_json(nullif(btrim(split_part({0}, ',', {2}), {3}), '')) "
+        u"ELSE json_build_array({0}) END"
+    ).format(column, _NUMBER, position + 1, _WS)
+
+
+def _match_hotel_speciality(column):
+    specialities = u', '.join(u"'{0}'".format(s) for s in sorted(ontology.RURAL_SPECIALITIES))
+    return (
+        u"CASE WHEN {0} IS NULL OR {0} = '' THEN NULL "
+        u"WHEN {0} ~ {1} THEN to_json(lower(regexp_replace(btrim({0}, {2}), '[\\s\\x1C-\\x1F]+', ' ', 'g')) "
+        u"IN ({3})) "
+        u"ELSE json_build_array({0}) END"
+    ).format(column, _ASCII, _WS, specialities)
+
+
+def _sql_transform(function, column):
+    # SQL expression of the transform of a text column, None if there is none
+    if function == 'cast_to_int':
+        return _cast_to_int(column)
+    elif function == 'stars_to_int':
+        return _stars_to_int(column)
+    elif function == 'str_to_coordinate_1':
+        return _str_to_coordinate(column, 0)
+    elif function == 'str_to_coordinate_2':
+        return _str_to_coordinate(column, 1)
+    elif function == 'match_hotel_speciality':
+        return _match_hotel_speciality(column)
+    return None
+
+
+def _finish(fallback, convert=None):
+    # column transform of the values computed in SQL: they are converted
+    # with `convert`, the ones left as [raw value] go through `fallback`
+    def transform(values, failed):
+        result = []
+        pending = []
+        for i, value in enumerate(values):
+            if type(value) is list:
+                pending.append(i)
+                result.append(None)
+            elif value is None or convert is None:
+                result.append(value)
+            else:
+                result.append(convert(value))
+        if pending:
+            for i, value in zip(pending, fallback([values[i][0] for i in pending], failed)):
+                result[i] = value
+        return result
+    return transform
+
+
+def _python_transform(prop, count_prepare_failures):
+    # the Python transform of a property, for the values SQL left out
+    if prop.prepare is None:
+        return prop.transform
+
+    def transform(values, failed):
+        # a column shared by several properties counts its failures once
+        prepared = prop.prepare(values, failed if count_prepare_failures else [])
+        return prop.transform(prepared, failed)
+    return transform
+
+
+def compile_sql_plan(plan, fields, unaccent):
+    """
+    Compile the transforms of `plan` that have an SQL equivalent. Returns a
+    SQLPlan with the expressions to select (the identifier and the
+    transformed properties, raw columns for the rest) and the OntologyPlan
+    converting the records they return.
+    """
+    types = dict((f[u'id'], f.get(u'type')) for f in fields)
+    identifier = datastore_postgres.identifier
+    expressions = [u'to_json("_id")']
+    raw_columns = {}
+
+    def raw(column):
+        if column not in raw_columns:
+            expressions.append(u'to_json({0})'.format(identifier(column)))
+            raw_columns[column] = len(expressions) - 1
+        return raw_columns[column]
+
+    if types.get(plan.id_column) == u'text':
+        expressions.append(_str_to_id(identifier(plan.id_column), unaccent))
+        id_index = len(expressions) - 1
+        id_transform = _finish(ontology.str_to_id)
+    else:
+        id_index = raw(plan.id_column)
+        id_transform = plan.id_transform
+
+    properties = []
+    prepared_columns = set()
+    for prop in plan.properties:
+        sql = None
+        if types.get(prop.column) == u'text':
+            sql = _sql_transform(prop.function, identifier(prop.column))
+        if sql is None:
+            properties.append(prop._replace(index=raw(prop.column)))
+            continue
+        expressions.append(sql)
+        fallback = _python_transform(prop, prop.column not in prepared_columns)
+        if prop.prepare is not None:
+            prepared_columns.add(prop.column)
+        if prop.function == 'match_hotel_speciality':
+            # the value the Python transform gives to a match
+            match = prop.transform([next(iter(ontology.RURAL_SPECIALITIES))], [])[0]
+            convert = lambda value, match=match: match if value else None
+        elif prop.prepare is not None:
+            # coordinates come as the text of the number
+            convert = float
+        else:
+            convert = None
+        properties.append(prop._replace(index=len(expressions) - 1, prepare=None,
+                                        transform=_finish(fallback, convert)))
+
+    return SQLPlan(
+        expressions=expressions,
+        plan=plan._replace(id_index=id_index, id_transform=id_transform, properties=tuple(properties)),
+    )
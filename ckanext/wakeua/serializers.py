@@ -0,0 +1,344 @@
+import hashlib
+import heapq
+import json
+import tempfile
+from itertools import groupby
+
+from ckan.plugins.toolkit import config, asint
+from rdflib import Literal, RDF, URIRef
+
+
+# terms kept by a TermCache, it is emptied when it grows beyond
+TERMS_CACHE_SIZE = 100000
+
+
+class TermCache(dict):
+    """
+    Text of the RDF terms of an export, rendered with `render` the first
+    time they are looked up. Predicates, classes and repeated literals
+    are rendered once per export instead of once per triple; the cache
+    is emptied when full, so the subjects of big exports don't pile up.
+    """
+
+    def __init__(self, render):
+        super(TermCache, self).__init__()
+        self.render = render
+
+    def __missing__(self, term):
+        if len(self) >= TERMS_CACHE_SIZE:
+            self.clear()
+        text = self[term] = self.render(term)
+        return text
+
+
+class RDFSerializer(object):
+    """
+    Turns the triples of one page of records into text. Pages are
+    serialized independently (possibly in other processes) and joined with
+    `separator`, between `header()` and `footer()`.
+
+    Serializers that need all the triples before writing them are `spooled`:
+    the serialized pages are handed to `spool()` instead of being written,
+    and `trailer()` produces the output once all the pages are spooled.
+    """
+    separator = u''
+    spooled = False
+
+    def __init__(self, graph, resource_metadata):
+        self.graph = graph
+        self.resource_metadata = resource_metadata
+
+    def header(self):
+        return u''
+
+    def serialize(self, triples):
+        raise NotImplementedError
+
+    def spool(self, chunk):
+        raise NotImplementedError
+
+    def trailer(self):
+        return iter(())
+
+    def footer(self):
+        return u''
+
+
+class TurtleSerializer(RDFSerializer):
+    """
+    Turtle with the prefixes bound in the graph, one triple per line.
+    """
+
+    def __init__(self, graph, resource_metadata):
+        super(TurtleSerializer, self).__init__(graph, resource_metadata)
+        self.namespace_manager = graph.namespace_manager
+        # qnames are costly to compute
+        self.terms = TermCache(self._n3)
+
+    def _n3(self, term):
+        return term.n3(self.namespace_manager)
+
+    def header(self):
+        return u''.join(
+            u'@prefix {0}: <{1}> .\n'.format(prefix, namespace) for prefix, namespace in self.graph.namespaces()
+        ) + u'\n'
+
+    def serialize(self, triples):
+        terms = self.terms
+        return u''.join(
+            u'{0} {1} {2} .\n'.format(terms[s], terms[p], terms[o]) for s, p, o in triples
+        )
+
+
+# memory used to sort the lines of a LineSpool before they are spilled to
+# temporary files
+SPOOL_MEMORY_MB = 'ckanext.wakeua.export.spool_memory_mb'
+
+# approximate memory used by a str object besides its characters
+LINE_OVERHEAD = 64
+
+# bytes of output yielded at once by the trailer of spooled serializers
+TRAILER_CHUNK_SIZE = 64 * 1024
+
+
+class LineSpool(object):
+    """
+    Sorts lines with bounded memory: they are kept in memory up to
+    `ckanext.wakeua.export.spool_memory_mb` and spilled to sorted temporary
+    files beyond it, which are merged by `sorted_lines()`.
+    """
+
+    def __init__(self):
+        self.memory_limit = asint(config.get(SPOOL_MEMORY_MB, 256)) * 1024 * 1024
+        self.lines = []
+        self.lines_size = 0
+        self.runs = []
+
+    def extend(self, lines, size):
+        self.lines.extend(lines)
+        # rough size of the str objects
+        self.lines_size += size + LINE_OVERHEAD * len(lines)
+        if self.lines_size > self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        self.lines.sort()
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8', prefix='wakeua-rdf-')
+        for line in self.lines:
+            run.write(line + u'\n')
+        run.seek(0)
+        self.runs.append(run)
+        self.lines = []
+        self.lines_size = 0
+
+    def sorted_lines(self):
+        # sorted lines without repetitions
+        self.lines.sort()
+        runs = [(line.rstrip(u'\n') for line in run) for run in self.runs]
+        previous = None
+        for line in heapq.merge(self.lines, *runs):
+            if line != previous:
+                yield line
+            previous = line
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.lines = []
+
+
+class GroupedTurtleSerializer(TurtleSerializer):
+    """
+    Turtle with the triples of each subject grouped, using `;` and `,`.
+    Pages are serialized to sorted "subject\tpredicate\tobject" lines and
+    sorted in a LineSpool, so memory stays bounded whatever the size of the
+    resource.
+    """
+    spooled = True
+
+    def __init__(self, graph, resource_metadata):
+        super(GroupedTurtleSerializer, self).__init__(graph, resource_metadata)
+        self.lines = LineSpool()
+
+    def _n3(self, term):
+        # one line per triple, line breaks in long literals are escaped
+        return term.n3(self.namespace_manager).replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+    def serialize(self, triples):
+        terms = self.terms
+        lines = []
+        for s, p, o in triples:
+            # rdf:type first, written as "a"
+            predicate = u' a' if p == RDF.type else terms[p]
+            lines.append(u'{0}\t{1}\t{2}'.format(terms[s], predicate, terms[o]))
+        lines.sort()
+        return u'\n'.join(lines)
+
+    def spool(self, chunk):
+        # the same triple may come from different pages, sorted_lines drops it
+        if chunk:
+            self.lines.extend(chunk.split(u'\n'), len(chunk))
+
+    def trailer(self):
+        try:
+            chunk = []
+            size = 0
+            triples = (line.split(u'\t', 2) for line in self.lines.sorted_lines())
+            for subject, subject_triples in groupby(triples, key=lambda t: t[0]):
+                predicates = []
+                for predicate, objects in groupby(subject_triples, key=lambda t: t[1]):
+                    predicates.append(u'{0} {1}'.format(
+                        predicate.strip(), u' ,\n        '.join(t[2] for t in objects)))
+                text = u'{0} {1} .\n\n'.format(subject, u' ;\n    '.join(predicates))
+                chunk.append(text)
+                size += len(text)
+                if size >= TRAILER_CHUNK_SIZE:
+                    yield u''.join(chunk)
+                    chunk = []
+                    size = 0
+            if chunk:
+                yield u''.join(chunk)
+        finally:
+            self.lines.close()
+
+
+def nt_term(term):
+    # N-Triples forbids prefixes and unescaped line breaks in literals, tabs
+    # are escaped too so snapshot lines can be tab separated
+    if isinstance(term, Literal):
+        value = u'"{0}"'.format(
+            term.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+            .replace(u'\t', u'\\t'))
+        if term.language:
+            return value + u'@' + term.language
+        if term.datatype:
+            return u'{0}^^<{1}>'.format(value, term.datatype)
+        return value
+    # formatted, adding a str to a URIRef makes (and validates) another URIRef
+    return u'<{0}>'.format(term)
+
+
+class NTriplesSerializer(RDFSerializer):
+
+    def __init__(self, graph, resource_metadata):
+        super(NTriplesSerializer, self).__init__(graph, resource_metadata)
+        self.terms = TermCache(nt_term)
+
+    def serialize(self, triples):
+        terms = self.terms
+        return u''.join(
+            u'{0} {1} {2} .\n'.format(terms[s], terms[p], terms[o]) for s, p, o in triples
+        )
+
+
+class NQuadsSerializer(NTriplesSerializer):
+    """
+    N-Quads with the CKAN resource page as the graph name.
+    """
+
+    def __init__(self, graph, resource_metadata):
+        super(NQuadsSerializer, self).__init__(graph, resource_metadata)
+        self.graph_name = nt_term(URIRef(u'{0}/dataset/{1}/resource/{2}'.format(
+            config.get('ckan.site_url', '').rstrip('/'),
+            resource_metadata.get('package_id'), resource_metadata.get('id'))))
+
+    def serialize(self, triples):
+        terms = self.terms
+        graph_name = self.graph_name
+        return u''.join(
+            u'{0} {1} {2} {3} .\n'.format(terms[s], terms[p], terms[o], graph_name) for s, p, o in triples
+        )
+
+
+def snapshot_record_key(subject):
+    # subjects are <namespace>#<record identifier>, see RDFSegitturWriter
+    return subject.rpartition(u'#')[2]
+
+
+class SnapshotSerializer(NTriplesSerializer):
+    """
+    Not an RDF format: one "record\thash\ttriple\ttriple..." line per
+    record, sorted by record identifier, with its N-Triples (without the
+    final " .") and a hash of them. Kept between loads to compute the
+    changes of the resource data, see delta.py.
+    """
+    spooled = True
+
+    def __init__(self, graph, resource_metadata):
+        super(SnapshotSerializer, self).__init__(graph, resource_metadata)
+        self.lines = LineSpool()
+
+    def serialize(self, triples):
+        terms = self.terms
+        records = {}
+        for s, p, o in triples:
+            records.setdefault(snapshot_record_key(s), []).append(
+                u'{0} {1} {2}'.format(terms[s], terms[p], terms[o]))
+        lines = []
+        for key, record_triples in records.items():
+            record_triples.sort()
+            text = u'\t'.join(record_triples)
+            lines.append(u'{0}\t{1}\t{2}'.format(key, hashlib.sha1(text.encode('utf-8')).hexdigest(), text))
+        return u'\n'.join(lines)
+
+    def spool(self, chunk):
+        if chunk:
+            self.lines.extend(chunk.split(u'\n'), len(chunk))
+
+    def trailer(self):
+        try:
+            chunk = []
+            size = 0
+            for line in self.lines.sorted_lines():
+                chunk.append(line + u'\n')
+                size += len(line)
+                if size >= TRAILER_CHUNK_SIZE:
+                    yield u''.join(chunk)
+                    chunk = []
+                    size = 0
+            if chunk:
+                yield u''.join(chunk)
+        finally:
+            self.lines.close()
+
+
+def _jsonld_value(term):
+    if isinstance(term, Literal):
+        value = {u'@value': str(term)}
+        if term.language:
+            value[u'@language'] = term.language
+        elif term.datatype:
+            value[u'@type'] = str(term.datatype)
+        return value
+    return {u'@id': str(term)}
+
+
+class JSONLDSerializer(RDFSerializer):
+    """
+    Expanded JSON-LD streamed as an array, one node object per subject
+    of a page.
+    """
+    separator = u',\n'
+
+    def __init__(self, graph, resource_metadata):
+        super(JSONLDSerializer, self).__init__(graph, resource_metadata)
+        # the value objects are shared, they are never modified
+        self.terms = TermCache(_jsonld_value)
+
+    def header(self):
+        return u'[\n'
+
+    def serialize(self, triples):
+        terms = self.terms
+        nodes = {}
+        for s, p, o in triples:
+            node = nodes.setdefault(s, {u'@id': str(s)})
+            if p == RDF.type:
+                node.setdefault(u'@type', []).append(str(o))
+            else:
+                node.setdefault(str(p), []).append(terms[o])
+        return self.separator.join(json.dumps(node, ensure_ascii=False) for node in nodes.values())
+
+    def footer(self):
+        return u'\n]\n'
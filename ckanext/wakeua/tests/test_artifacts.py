@@ -0,0 +1,17 @@
+"""
+Tests for artifacts.py.
+"""
+from ckanext.wakeua import artifacts
+
+
+def test_bump_datastore_version(tmp_path, monkeypatch):
+    monkeypatch.setitem(artifacts.config, 'ckan.storage_path', str(tmp_path))
+    assert artifacts.datastore_version(u'res-1') == u''
+
+    artifacts.bump_datastore_version(u'res-1')
+    version = artifacts.datastore_version(u'res-1')
+    artifacts.bump_datastore_version(u'res-1')
+
+    assert version
+    assert artifacts.datastore_version(u'res-1') not in (u'', version)
+    assert artifacts.datastore_version(u'res-2') == u''
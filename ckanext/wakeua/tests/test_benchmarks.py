@@ -0,0 +1,229 @@
+"""
+Benchmarks of the export, indexing and rendering hot paths.
+
+They use synthetic datastore pages and package dicts, no Solr or Postgres
+is needed. Run them with:
+
+    pytest --ckan-ini=test.ini ckanext/wakeua/tests/test_benchmarks.py
+
+The number of rows exported is set with WAKEUA_BENCHMARK_ROWS (a comma
+separated list, 10000 by default), e.g. WAKEUA_BENCHMARK_ROWS=10000,1000000.
+Throughput, peak memory and output size are stored in the `extra_info` of
+each benchmark, use --benchmark-json or --benchmark-autosave to keep them
+and --benchmark-compare to spot regressions. They are left out of the CI
+test run with --benchmark-skip.
+"""
+import copy
+import json
+import os
+import tracemalloc
+from io import StringIO
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+from ckanext.wakeua import helpers as wh
+from ckanext.wakeua import logic
+from ckanext.wakeua import serializers
+import ckanext.wakeua.plugin as plugin
+
+BENCHMARK_ROWS = [int(rows) for rows in os.environ.get('WAKEUA_BENCHMARK_ROWS', '10000').split(',')]
+
+PACKAGES = 1000
+
+LANGS = 'es ca en'
+
+TURISMO = 'https://ontologia.segittur.es/turismo/def/core#'
+
+
+def _field(name, field_type, *infos):
+    return {'id': name, 'type': field_type,
+            'info': {'ontology': str([dict(info, ontology=TURISMO, prefix='turismo') for info in infos])}}
+
+
+# a data dictionary using every ontology transform function
+DATASTORE_INFO = [
+    _field('signatura', 'text', {'predicate': 'turismo:Hotel', 'function': 'str_to_id'}),
+    _field('nombre', 'text', {'predicate': 'turismo:name'}),
+    _field('plazas', 'text', {'predicate': 'turismo:capacity', 'function': 'cast_to_int'}),
+    _field('categoria', 'text', {'predicate': 'turismo:stars', 'function': 'stars_to_int'}),
+    _field('especialidad', 'text', {'predicate': 'turismo:hotelType', 'function': 'match_hotel_speciality'}),
+    _field('coordenadas', 'text',
+           {'predicate': 'turismo:hasGeo/turismo:Geo/turismo:lat', 'function': 'str_to_coordinate_1'},
+           {'predicate': 'turismo:hasGeo/turismo:Geo/turismo:long', 'function': 'str_to_coordinate_2'}),
+    _field('direccion', 'text', {'predicate': 'turismo:hasAddress/turismo:Address/turismo:streetAddress'}),
+]
+
+FIELDS = [{'id': '_id', 'type': 'int'}] + [{'id': f['id'], 'type': f['type']} for f in DATASTORE_INFO]
+
+RESOURCE = {'id': 'benchmark-resource', 'package_id': 'benchmark-package'}
+
+PACKAGE = {'name': 'benchmark-package', 'organization': {'name': 'alcoi'}}
+
+LOCATION = (('country', u'España'), ('autonomous_community', u'Comunitat Valenciana'),
+            ('province', u'Alicante'), ('city', u'Alcoi'))
+
+STARS = ['Una estrella', 'Dos estrellas', 'Tres estrellas', '4e', 'CINCO', '']
+
+SPECIALITIES = ['Casa rural', 'Hotel', 'Rural', 'Apartahotel', '']
+
+
+def _records(rows):
+    return [[
+        i + 1,
+        u'CV-H{0:05d}-A'.format(i),
+        u' Hotel Benidorm nº {0} '.format(i),
+        str(10 + i % 300),
+        STARS[i % len(STARS)],
+        SPECIALITIES[i % len(SPECIALITIES)],
+        u'{0:.6f}, {1:.6f}'.format(38.3 + i % 1000 * 0.0001, -0.5 - i % 1000 * 0.0001) if i % 50 else u'x',
+        u'Avinguda de l\'Estació, {0}'.format(i % 200),
+    ] for i in range(rows)]
+
+
+def _pages(records):
+    return [records[i:i + logic.PAGINATE_BY] for i in range(0, len(records), logic.PAGINATE_BY)]
+
+
+def _export(pages, serializer):
+    # same as logic.convert_resource_data, with the pages already fetched
+    size = 0
+    stream = StringIO()
+    with logic.rdf_segittur_writer(FIELDS, RESOURCE, PACKAGE, DATASTORE_INFO, stream, serializer,
+                                   LOCATION) as wr:
+        for records in pages:
+            wr.write_records(records)
+            size += len(logic._drain(stream))
+    return size + len(logic._drain(stream))
+
+
+def _peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _record_throughput(benchmark, items, name):
+    if benchmark.stats:
+        benchmark.extra_info[name + '_per_second'] = items / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize('serializer', [
+    serializers.TurtleSerializer,
+    serializers.NTriplesSerializer,
+    serializers.JSONLDSerializer,
+], ids=['turtle', 'ntriples', 'jsonld'])
+@pytest.mark.parametrize('rows', BENCHMARK_ROWS)
+def test_benchmark_rdf_export(benchmark, rows, serializer):
+    benchmark.group = 'rdf-export-{0}'.format(rows)
+    pages = _pages(_records(rows))
+
+    size = benchmark.pedantic(_export, args=(pages, serializer), rounds=3, iterations=1)
+
+    assert size > 0
+    benchmark.extra_info['rows'] = rows
+    benchmark.extra_info['output_bytes'] = size
+    benchmark.extra_info['peak_memory_bytes'] = _peak_memory(_export, pages, serializer)
+    _record_throughput(benchmark, rows, 'rows')
+
+
+def _multilingual(text, i):
+    return json.dumps({'es': u'{0} {1} en español'.format(text, i),
+                       'ca': u'{0} {1} en valencià'.format(text, i),
+                       'en': u'{0} {1} in English'.format(text, i)}, ensure_ascii=False)
+
+
+def _package_dicts():
+    return [{
+        'name': 'dataset-{0}'.format(i),
+        'title': _multilingual(u'Alojamientos turísticos', i),
+        'notes': _multilingual(u'Listado de **alojamientos** de la Comunitat', i),
+        'spatial': '{"type": "Point", "coordinates": [-0.48, 38.34]}',
+        'extras_tag_string_schemaorg': 'turismo, hoteles, alojamiento',
+        'res_name': [_multilingual(u'Hoteles', i), _multilingual(u'Campings', i)],
+        'res_description': [_multilingual(u'Hoteles de la provincia', i), u'sin traducir'],
+        'resources': [{
+            'id': 'resource-{0}-{1}'.format(i, j),
+            'name': {'es': u'Hoteles', 'ca': u'Hotels', 'en': u'Hotels'},
+            'description': {'es': u'Hoteles de la provincia', 'ca': u'Hotels de la província'},
+            'format': 'CSV',
+            'tracking_summary': {'total': 0, 'recent': 0},
+        } for j in range(3)],
+    } for i in range(PACKAGES)]
+
+
+@pytest.fixture
+def ca_request(test_request_context):
+    with test_request_context():
+        toolkit.request.environ['CKAN_LANG'] = 'ca'
+        yield
+
+
+@pytest.mark.ckan_config('ckan.locale_order', LANGS)
+def test_benchmark_before_index(benchmark):
+    benchmark.group = 'plugin-hooks'
+    wakeua = plugin.WakeuaPlugin()
+    packages = _package_dicts()
+
+    def setup():
+        return (copy.deepcopy(packages),), {}
+
+    def index(pkg_dicts):
+        return [wakeua.before_index(pkg_dict) for pkg_dict in pkg_dicts]
+
+    indexed = benchmark.pedantic(index, setup=setup, rounds=5, iterations=1)
+
+    assert indexed[0]['title_ca'] == u'Alojamientos turísticos 0 en valencià'
+    benchmark.extra_info['packages'] = PACKAGES
+    benchmark.extra_info['peak_memory_bytes'] = _peak_memory(index, copy.deepcopy(packages))
+    _record_throughput(benchmark, PACKAGES, 'packages')
+
+
+@pytest.mark.ckan_config('ckan.locale_order', LANGS)
+@pytest.mark.usefixtures('ca_request')
+def test_benchmark_before_view(benchmark):
+    benchmark.group = 'plugin-hooks'
+    wakeua = plugin.WakeuaPlugin()
+    packages = _package_dicts()
+
+    def setup():
+        return (copy.deepcopy(packages),), {}
+
+    def view(pkg_dicts):
+        return [wakeua.before_view(pkg_dict) for pkg_dict in pkg_dicts]
+
+    viewed = benchmark.pedantic(view, setup=setup, rounds=5, iterations=1)
+
+    assert viewed[0]['title'] == u'Alojamientos turísticos 0 en valencià'
+    benchmark.extra_info['packages'] = PACKAGES
+    benchmark.extra_info['peak_memory_bytes'] = _peak_memory(view, copy.deepcopy(packages))
+    _record_throughput(benchmark, PACKAGES, 'packages')
+
+
+@pytest.mark.ckan_config('ckan.locale_order', LANGS)
+@pytest.mark.usefixtures('ca_request')
+def test_benchmark_helpers(benchmark):
+    benchmark.group = 'helpers'
+    packages = _package_dicts()
+
+    def render(pkg_dicts):
+        # what the dataset list snippets call for each dataset
+        output = []
+        for pkg_dict in pkg_dicts:
+            output.append(wh.wakeua_dataset_display_name(pkg_dict))
+            output.append(wh.wakeua_truncate(pkg_dict['title'], 80))
+            output.append(wh.wakeua_markdown_extract(wh.wakeua_force_translate(pkg_dict['notes'])))
+            for resource in pkg_dict['resources']:
+                output.append(wh.wakeua_resource_display_name(resource))
+        return output
+
+    output = benchmark(render, packages)
+
+    assert output[1] == u'Alojamientos turísticos 0 en valencià'
+    benchmark.extra_info['packages'] = PACKAGES
+    benchmark.extra_info['output_bytes'] = sum(len(value) for value in output)
+    benchmark.extra_info['cache_stats'] = wh.wakeua_cache_stats()
+    _record_throughput(benchmark, PACKAGES, 'packages')
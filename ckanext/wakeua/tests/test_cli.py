@@ -0,0 +1,45 @@
+"""
+Tests for cli.py.
+"""
+import datetime
+
+from ckanext.wakeua import cli
+
+
+class _Results(object):
+
+    def __init__(self, docs, next_cursor):
+        self.docs = docs
+        self.nextCursorMark = next_cursor
+
+
+class _Connection(object):
+    # Solr connection returning one page of documents per cursor
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def search(self, q, **kwargs):
+        self.calls.append(kwargs)
+        docs, next_cursor = self.pages[kwargs['cursorMark']]
+        return _Results(docs, next_cursor)
+
+
+def test_indexed_datasets(monkeypatch):
+    conn = _Connection({
+        u'*': ([{'id': u'a', 'metadata_modified': u'2023-01-01T10:00:00.123456Z'}], u'c1'),
+        u'c1': ([{'id': u'b', 'metadata_modified': u'2023-01-02T10:00:00Z'}], u'c2'),
+        u'c2': ([], u'c2'),
+    })
+    monkeypatch.setattr(cli, 'make_connection', lambda: conn)
+
+    indexed = cli._indexed_datasets()
+
+    assert indexed == {
+        u'a': datetime.datetime(2023, 1, 1, 10, 0, 0, 123000),
+        u'b': datetime.datetime(2023, 1, 2, 10, 0, 0),
+    }
+    # Solr rejects cursors without the uniqueKey in the sort
+    assert all(call['sort'] == u'index_id asc' for call in conn.calls)
+    assert [call['cursorMark'] for call in conn.calls] == [u'*', u'c1', u'c2']
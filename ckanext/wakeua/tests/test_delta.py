@@ -0,0 +1,42 @@
+"""
+Tests for delta.py.
+"""
+import gzip
+
+from ckanext.wakeua import delta
+
+HOTEL = u'<https://tdata.dlsi.ua.es/recurso/turismo/hotel#{0}>'
+NAME = u'<https://ontologia.segittur.es/turismo/def/core#name>'
+
+
+def _snapshot(path, records):
+    # records: {identifier: [name, ...]}, written like SnapshotSerializer
+    with gzip.open(str(path), 'wt', encoding='utf-8') as f:
+        for identifier in sorted(records, key=lambda i: i + u'\t'):
+            triples = sorted(u'{0} {1} "{2}"'.format(HOTEL.format(identifier), NAME, name)
+                             for name in records[identifier])
+            f.write(u'{0}\t{1}\t{2}\n'.format(identifier, hash(tuple(triples)), u'\t'.join(triples)))
+    return str(path)
+
+
+def test_diff_snapshots(tmp_path):
+    old = _snapshot(tmp_path / 'old', {u'A': [u'a'], u'AB': [u'ab'], u'B': [u'b', u'b2'], u'C': [u'c']})
+    new = _snapshot(tmp_path / 'new', {u'A': [u'a'], u'AB': [u'ab 2'], u'B': [u'b'], u'D': [u'd']})
+
+    changes = sorted(delta.diff_snapshots(old, new))
+
+    assert changes == sorted([
+        ('D', u'{0} {1} "ab"'.format(HOTEL.format(u'AB'), NAME)),
+        ('A', u'{0} {1} "ab 2"'.format(HOTEL.format(u'AB'), NAME)),
+        ('D', u'{0} {1} "b2"'.format(HOTEL.format(u'B'), NAME)),
+        ('D', u'{0} {1} "c"'.format(HOTEL.format(u'C'), NAME)),
+        ('A', u'{0} {1} "d"'.format(HOTEL.format(u'D'), NAME)),
+    ])
+
+
+def test_rdf_patch_of_same_version(tmp_path):
+    snapshot = _snapshot(tmp_path / 'old', {u'A': [u'a']})
+
+    patch = u''.join(delta.rdf_patch(snapshot, snapshot, u'1', u'1'))
+
+    assert patch == u'H id <urn:wakeua:version:1> .\nH prev <urn:wakeua:version:1> .\nTX .\nTC .\n'
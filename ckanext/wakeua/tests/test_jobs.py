@@ -0,0 +1,36 @@
+"""
+Tests for jobs.py.
+"""
+import datetime
+
+from ckanext.wakeua import jobs
+
+RESOURCE = {'id': 'res-1', 'fingerprint': '["url", null, 10]', 'datastore_active': True}
+
+
+def _actions(monkeypatch, fingerprint, status, minutes_ago=0):
+    updated = (datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes_ago)).isoformat()
+    actions = {
+        'task_status_show': lambda context, data_dict: {'value': fingerprint, 'last_updated': updated},
+        'xloader_status': lambda context, data_dict: {'status': status, 'last_updated': updated},
+    }
+    monkeypatch.setattr(jobs.toolkit, 'get_action', actions.get)
+
+
+def test_load_state(monkeypatch):
+    _actions(monkeypatch, RESOURCE['fingerprint'], 'complete')
+    assert jobs._load_state({}, RESOURCE) == 'loaded'
+
+    # submitted, not loaded yet
+    _actions(monkeypatch, RESOURCE['fingerprint'], 'pending')
+    assert jobs._load_state({}, RESOURCE) == 'loading'
+
+    # lost or failed loads are submitted again
+    _actions(monkeypatch, RESOURCE['fingerprint'], 'pending', minutes_ago=120)
+    assert jobs._load_state({}, RESOURCE) == 'submit'
+    _actions(monkeypatch, RESOURCE['fingerprint'], 'error')
+    assert jobs._load_state({}, RESOURCE) == 'submit'
+
+    # another version of the file
+    _actions(monkeypatch, '["url", null, 11]', 'complete')
+    assert jobs._load_state({}, RESOURCE) == 'submit'
@@ -0,0 +1,39 @@
+"""
+Tests for locations.py.
+"""
+from ckanext.wakeua import locations
+
+
+def test_index_locations():
+    table = {
+        'country': u'España',
+        'organizations': {
+            'alcoi': {'autonomous_community': u'Comunitat Valenciana', 'province': u'Alicante', 'city': u'Alcoi'},
+            'gva': {'autonomous_community': u'Comunitat Valenciana', 'city': u'Valencia'},
+        },
+    }
+    extras = {
+        'alcoi': {'city': u'Alcoy', 'province': u''},
+        'elche': {'province': u'Alicante', 'city': u'Elche'},
+    }
+
+    index, default = locations.index_locations(table, extras)
+
+    # the organization fields take precedence, empty ones are ignored
+    assert index['alcoi'] == (('country', u'España'), ('autonomous_community', u'Comunitat Valenciana'),
+                              ('province', u'Alicante'), ('city', u'Alcoy'))
+    # the city is only used along with the province
+    assert index['gva'] == (('country', u'España'), ('autonomous_community', u'Comunitat Valenciana'))
+    assert index['elche'] == (('country', u'España'), ('province', u'Alicante'), ('city', u'Elche'))
+    assert default == (('country', u'España'),)
+
+
+def test_table_locations():
+    locations.load_table()
+
+    index, default = locations.index_locations(locations._table, {})
+
+    assert dict(index['torrent']) == {'country': u'España', 'autonomous_community': u'Comunitat Valenciana',
+                                      'province': u'Valencia', 'city': u'Torrent'}
+    assert dict(index['dipcas']) == {'country': u'España', 'autonomous_community': u'Comunitat Valenciana',
+                                     'province': u'Castellon'}
@@ -0,0 +1,114 @@
+"""
+Tests for ontology.py.
+"""
+from rdflib.namespace import Namespace
+
+from ckanext.wakeua import ontology
+
+TURISMO = 'https://ontologia.segittur.es/turismo/def/core#'
+
+
+def _field(name, *infos):
+    return {'id': name, 'info': {'ontology': str([dict(info, ontology=TURISMO, prefix='turismo')
+                                                  for info in infos])}}
+
+
+DATASTORE_INFO = [
+    _field('signatura', {'predicate': 'turismo:Hotel', 'function': 'str_to_id'}),
+    _field('nombre', {'predicate': 'turismo:name'}),
+    _field('coords',
+           {'predicate': 'turismo:hasGeo/turismo:Geo/turismo:lat', 'function': 'str_to_coordinate_1'},
+           {'predicate': 'turismo:hasGeo/turismo:Geo/turismo:long', 'function': 'str_to_coordinate_2'}),
+]
+
+
+def test_str_to_id():
+    failed = []
+    assert ontology.str_to_id([u' cv h 1 á', None, u' ', u'#'], failed) == ['CV_H_1_A', None, None, None]
+    assert failed == [None, u' ', u'#']
+
+
+def test_cast_to_int():
+    failed = []
+    assert ontology.cast_to_int(['1', ' 2 '], failed) == [1, 2]
+    assert ontology.cast_to_int(['3.6', '', None, 'x'], failed) == [4, None, None, None]
+    assert failed == ['x']
+
+
+def test_stars_to_int():
+    failed = []
+    assert ontology.stars_to_int(['Tres estrellas', '4e', 'x', ''], failed) == [3, 4, None, None]
+    assert failed == ['x']
+
+
+def test_transforms_of_non_text_columns():
+    failed = []
+    assert ontology.cast_to_int([3, 2.6, [1]], failed) == [3, 3, None]
+    assert ontology.stars_to_int([3, [1, 2]], failed) == [3, None]
+    assert failed == ['[1]', [1, 2]]
+    prepare, transform = ontology.get_transform(
+        'match_hotel_speciality', {'turismo': Namespace(TURISMO)})
+    assert transform([3, ['Rural']], []) == [None, None]
+
+
+def test_match_hotel_speciality():
+    prepare, transform = ontology.get_transform(
+        'match_hotel_speciality', {'turismo': Namespace(TURISMO)})
+    assert transform(['Casa  Rural', 'hotel', None], []) == [Namespace(TURISMO)['ruralHotel'], None, None]
+
+
+def test_transform_page():
+    columns = ['_id', 'signatura', 'nombre', 'coords']
+    plan = ontology.compile_ontology_plan(ontology.parse_ontology_dict(DATASTORE_INFO), columns)
+    errors = ontology.TransformErrors()
+
+    identifiers, values = ontology.transform_page(
+        plan, [[1, 'h 1', ' Hotel ', '38.5, -0.4'], [2, 'h 2', 'Hostal', 'x']], errors)
+
+    assert identifiers == ['H_1', 'H_2']
+    assert [p.column for p in plan.properties] == ['nombre', 'coords', 'coords']
+    assert values == [['Hotel', 'Hostal'], [38.5, None], [-0.4, None]]
+    assert errors.counts == {('str_to_coordinate_1', 'coords'): 1}
+
+
+def test_validate_ontology_dictionary():
+    assert ontology.validate_ontology_dictionary(DATASTORE_INFO) == {}
+    assert ontology.validate_ontology_dictionary([{'id': 'other', 'info': {'ontology': ''}}]) == {}
+
+    errors = ontology.validate_ontology_dictionary(DATASTORE_INFO + [
+        _field('plazas', {'predicate': 'turismo:capacity', 'function': 'to_int'}),
+        _field('web', {'predicate': 'schema:url'}),
+        {'id': 'broken', 'info': {'ontology': "[{'ontology': "}},
+    ])
+
+    assert list(errors) == ['plazas', 'web', 'broken']
+    assert errors['plazas'] == ['Unknown ontology function "to_int"']
+    assert errors['web'] == ['Prefix "schema" of predicate "schema:url" is not defined']
+    assert errors['broken'][0].startswith('Ontology is not valid JSON')
+
+
+def test_validate_ontology_dictionary_identifier():
+    errors = ontology.validate_ontology_dictionary(DATASTORE_INFO[1:])
+    assert errors == {'nombre': ['The ontology mapping needs exactly one "str_to_id" identifier field']}
+
+
+def test_get_ontology_plan():
+    columns = ['_id', 'signatura', 'nombre', 'coords']
+    plan = ontology.get_ontology_plan('resource-id', DATASTORE_INFO, columns)
+    assert ontology.get_ontology_plan('resource-id', DATASTORE_INFO, columns) is plan
+    assert ontology.get_ontology_plan('resource-id', DATASTORE_INFO[:2], columns) is not plan
+
+
+def test_mapped_columns():
+    datastore_info = [{'id': 'web', 'info': {}}] + DATASTORE_INFO
+
+    assert ontology.mapped_columns(datastore_info) == ('signatura', ['signatura', 'nombre', 'coords'])
+    assert ontology.mapped_columns(DATASTORE_INFO[1:]) == (None, ['nombre', 'coords'])
+
+
+def test_export_columns():
+    datastore_info = [{'id': 'web', 'info': {}}] + DATASTORE_INFO
+
+    assert ontology.export_columns(datastore_info) == ['_id', 'signatura', 'nombre', 'coords']
+    # without an identifier every column is exported
+    assert ontology.export_columns(datastore_info[:1] + DATASTORE_INFO[1:]) == ['_id', 'web', 'nombre', 'coords']
@@ -0,0 +1,38 @@
+"""
+Tests for pushdown.py.
+"""
+from ckanext.wakeua import ontology
+from ckanext.wakeua import pushdown
+from ckanext.wakeua.tests.test_ontology import DATASTORE_INFO
+
+COLUMNS = ['_id', 'signatura', 'nombre', 'coords']
+
+FIELDS = [{'id': '_id', 'type': 'int'}] + [{'id': f['id'], 'type': 'text'} for f in DATASTORE_INFO]
+
+
+def test_compile_sql_plan():
+    plan = ontology.compile_ontology_plan(ontology.parse_ontology_dict(DATASTORE_INFO), COLUMNS)
+
+    sql_plan = pushdown.compile_sql_plan(plan, FIELDS, False)
+
+    # _id, identifier, raw nombre, latitude and longitude
+    assert len(sql_plan.expressions) == 5
+    assert sql_plan.expressions[2] == 'to_json("nombre")'
+    assert [p.index for p in sql_plan.plan.properties] == [2, 3, 4]
+
+
+def test_sql_plan_falls_back_to_python():
+    plan = ontology.compile_ontology_plan(ontology.parse_ontology_dict(DATASTORE_INFO), COLUMNS)
+    sql_plan = pushdown.compile_sql_plan(plan, FIELDS, False)
+    # values as returned by the SQL expressions, [raw value] when left to Python
+    records = [
+        [1, 'H_1', ' Hotel ', '38.5', '-0.4'],
+        [2, [u'h ñ'], 'Hostal', ['x'], ['x']],
+    ]
+    errors = ontology.TransformErrors()
+
+    identifiers, values = ontology.transform_page(sql_plan.plan, records, errors)
+
+    assert identifiers == ['H_1', 'H_N']
+    assert values == [['Hotel', 'Hostal'], [38.5, None], [-0.4, None]]
+    assert errors.counts == {('str_to_coordinate_1', 'coords'): 1}
@@ -0,0 +1,170 @@
+"""
+Tests for serializers.py.
+"""
+import re
+from io import StringIO
+
+from rdflib import Dataset, Graph, Literal, Namespace, RDF, URIRef, XSD
+from rdflib.compare import isomorphic
+
+from ckanext.wakeua import logic
+from ckanext.wakeua import serializers
+from ckanext.wakeua.tests.test_ontology import DATASTORE_INFO
+
+TURISMO = Namespace('https://ontologia.segittur.es/turismo/def/core#')
+HOTEL = Namespace('https://tdata.dlsi.ua.es/recurso/turismo/hotel#')
+
+RESOURCE = {'id': 'res-1', 'package_id': 'pkg-1'}
+
+
+def _graph():
+    # prefix bookkeeping, like logic.rdf_segittur_writer
+    g = Graph()
+    g.bind('turismo', TURISMO)
+    g.bind('hotel', HOTEL)
+    return g
+
+
+def _pages():
+    # the same subjects and triples come in several pages
+    pages = []
+    for page in range(3):
+        triples = []
+        for i in range(page, page + 4):
+            hotel = HOTEL['H_{0}'.format(i)]
+            triples += [
+                (hotel, RDF.type, TURISMO.Hotel),
+                (hotel, TURISMO.name, Literal(u'Hotel {0}\nline 2\r\n"quoted"'.format(i))),
+                (hotel, TURISMO.capacity, Literal(i, datatype=XSD.integer)),
+                (hotel, TURISMO.category, Literal(u'c{0}'.format(i % 2))),
+                (hotel, TURISMO.category, Literal(u'c{0}'.format(i % 2 + 2))),
+            ]
+        pages.append(triples)
+    return pages
+
+
+def _parse(data):
+    g = Graph()
+    g.parse(data=data, format='turtle')
+    return g
+
+
+def test_grouped_turtle_spills_and_merges(monkeypatch):
+    # every page goes to its own sorted run
+    monkeypatch.setitem(serializers.config, serializers.SPOOL_MEMORY_MB, '0')
+    grouped = serializers.GroupedTurtleSerializer(_graph(), RESOURCE)
+    plain = serializers.TurtleSerializer(_graph(), RESOURCE)
+    pages = _pages()
+
+    output = [grouped.header()]
+    for triples in pages:
+        grouped.spool(grouped.serialize(triples))
+    assert len(grouped.lines.runs) == len(pages)
+    output += list(grouped.trailer()) + [grouped.footer()]
+    reference = plain.header() + u''.join(plain.serialize(triples) for triples in pages) + plain.footer()
+
+    g = _parse(u''.join(output))
+    assert isomorphic(g, _parse(reference))
+    # the repeated triples are written once
+    assert len(g) == 6 * 5
+    assert grouped.lines.runs == []
+
+
+def test_grouped_turtle_groups_by_subject():
+    grouped = serializers.GroupedTurtleSerializer(_graph(), RESOURCE)
+    grouped.spool(grouped.serialize(_pages()[0]))
+
+    output = u''.join(grouped.trailer())
+
+    # one statement per subject, rdf:type first and the objects of a
+    # predicate separated with ","
+    assert output.count(u'hotel:H_0 a turismo:Hotel ;') == 1
+    assert u'turismo:category "c0" ,\n        "c2"' in output
+    # line breaks of long literals are escaped, one triple per line
+    assert u'turismo:name """Hotel 0\\nline 2\\r\\n"quoted\\"""" .' in output
+    g = _parse(grouped.header() + output)
+    assert g.value(HOTEL.H_0, TURISMO.name) == Literal(u'Hotel 0\nline 2\r\n"quoted"')
+
+
+def test_line_spool_drops_repeated_lines(monkeypatch):
+    monkeypatch.setitem(serializers.config, serializers.SPOOL_MEMORY_MB, '0')
+    spool = serializers.LineSpool()
+    spool.extend([u'b', u'a', u'c'], 3)
+    spool.extend([u'c', u'a'], 2)
+    spool.extend([u'd', u'b'], 2)
+
+    try:
+        assert len(spool.runs) == 3
+        assert list(spool.sorted_lines()) == [u'a', u'b', u'c', u'd']
+    finally:
+        spool.close()
+
+
+def _literal_triples():
+    hotel = HOTEL[u'CAÑADA_1']
+    return [
+        (hotel, RDF.type, TURISMO.Hotel),
+        (hotel, TURISMO.name, Literal(u'Hotel "La Cañada"\\ \n\r\tfin')),
+        (hotel, TURISMO.description, Literal(u'Hotel en la playa', lang=u'es')),
+        (hotel, TURISMO.capacity, Literal(u'12', datatype=XSD.integer)),
+        (hotel, TURISMO.latitude, Literal(38.5)),
+        (hotel, TURISMO.sameAs, HOTEL[u'ÁLTEA_2']),
+    ]
+
+
+def _reference():
+    g = Graph()
+    for triple in _literal_triples():
+        g.add(triple)
+    return g
+
+
+def test_ntriples_round_trip():
+    serializer = serializers.NTriplesSerializer(_graph(), RESOURCE)
+
+    output = serializer.header() + serializer.serialize(_literal_triples()) + serializer.footer()
+
+    g = Graph()
+    g.parse(data=output, format='nt')
+    assert isomorphic(g, _reference())
+    # one line per triple
+    assert len(output.splitlines()) == len(_literal_triples())
+
+
+def test_nquads_round_trip(monkeypatch):
+    monkeypatch.setitem(serializers.config, 'ckan.site_url', 'http://test.ckan.net/')
+    serializer = serializers.NQuadsSerializer(_graph(), RESOURCE)
+
+    output = serializer.header() + serializer.serialize(_literal_triples()) + serializer.footer()
+
+    g = Dataset()
+    g.parse(data=output, format='nquads')
+    graphs = [c for c in g.contexts() if len(c)]
+    assert len(graphs) == 1
+    assert graphs[0].identifier == URIRef(u'http://test.ckan.net/dataset/pkg-1/resource/res-1')
+    assert isomorphic(Graph() + graphs[0], _reference())
+
+
+def test_jsonld_round_trip():
+    serializer = serializers.JSONLDSerializer(_graph(), RESOURCE)
+    triples = _literal_triples()
+
+    # two pages, joined like logic.convert_resource_data does
+    output = serializer.header() + serializer.separator.join(
+        [serializer.serialize(triples[:3]), serializer.serialize(triples[3:])]) + serializer.footer()
+
+    g = Graph()
+    g.parse(data=output, format='json-ld')
+    assert isomorphic(g, _reference())
+
+
+def test_turtle_header_declares_the_mapping_prefixes():
+    stream = StringIO()
+    fields = [{'id': '_id'}] + [{'id': f['id']} for f in DATASTORE_INFO]
+
+    with logic.rdf_segittur_writer(fields, RESOURCE, {}, DATASTORE_INFO, stream):
+        pass
+
+    # not the prefixes rdflib binds by default (brick, dcat...)
+    assert re.findall(r'@prefix (\w+):', stream.getvalue()) == [
+        'rdf', 'xsd', 'turismo', 'hotel', 'location', 'geo']